@@ -0,0 +1,436 @@
+"""
+Offline benchmark for pulse-notify.
+
+Replays a corpus of recorded Pulse messages through NotifyConsumer.dispatch with every external service replaced by a
+local stub: Taskcluster (task definitions, live logs and buildbot properties) is served over HTTP by an aiohttp server
+on localhost, and the S3/SES/SNS, SMTP and IRC clients are swapped for in-process fakes with a configurable latency.
+Nothing leaves the machine, so the numbers can be compared between branches.
+
+Usage:
+    python benchmarks/replay.py --messages 2000 --in-flight 20
+
+Reports messages/sec, p50/p99 latency from dispatch until the last notification of the message was sent and the
+message acknowledged, and peak RSS. Exits non-zero when the p99 latency is above --max-p99.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay recorded Pulse messages against local stubs.')
+    parser.add_argument('--messages', type=int, default=1000, help='number of messages to replay')
+    parser.add_argument('--corpus', default=os.path.join(HERE, 'corpus.json'), help='recorded messages to replay')
+    parser.add_argument('--task-latency', type=float, default=0.02, help='seconds to serve a task definition')
+    parser.add_argument('--log-latency', type=float, default=0.05, help='seconds before a log starts streaming')
+    parser.add_argument('--log-size', type=int, default=256 * 1024, help='size of each served log in bytes')
+    parser.add_argument('--sink-latency', type=float, default=0.03,
+                        help='seconds each S3/SES/SNS/SMTP call blocks for')
+    parser.add_argument('--in-flight', type=int, default=None, help='override PN_MAX_IN_FLIGHT')
+    parser.add_argument('--repeat-tasks', action='store_true',
+                        help='replay the corpus taskIds as they are instead of making each message a new task '
+                             '(repeated messages are then skipped as duplicates)')
+    parser.add_argument('--max-p99', type=float, default=None, help='fail if the p99 latency (seconds) is above this')
+    parser.add_argument('--verbose', action='store_true', help='log at DEBUG level')
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def configure_environment(args, port):
+    #  pulsenotify reads its configuration from the environment at import time, so this has to happen first
+    defaults = {
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'S3_BUCKET': 'benchmark-logs',
+        'SES_EMAIL': 'pulse-notify@example.com',
+        'SNS_ARN': 'arn:aws:sns:us-west-2:000000000000:benchmark',
+        'SMTP_EMAIL': 'pulse-notify@example.com',
+        'SMTP_PASSWD': 'benchmark',
+        'SMTP_HOST': '127.0.0.1',
+        'SMTP_PORT': '25',
+        'IRC_HOST': '127.0.0.1',
+        'IRC_PORT': '6697',
+        'IRC_NICK': 'pn-benchmark',
+        'IRC_NAME': 'pn-benchmark',
+        'IRC_PASS': 'benchmark',
+        'IRC_LINES_PER_SECOND': '10000',
+        'PN_SERVICES': 'log_collect:ses:sns:smtp:irc',
+        'ID_ENV': 'dev',
+        'ROUTING_KEYS': 'route.connor',
+        'INFLUXDB_RECORD': '0',
+        'PN_SPOOL_PATH': os.path.join(tempfile.gettempdir(), 'pulsenotify-benchmark-spool.sqlite3'),
+        #  A new manifest for every run, so logs uploaded by a previous run aren't skipped
+        'LOG_COLLECT_MANIFEST_PATH': os.path.join(tempfile.mkdtemp(prefix='pulsenotify-benchmark-'),
+                                                  'uploads.sqlite3'),
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    os.environ['TASKCLUSTER_QUEUE_URL'] = 'http://127.0.0.1:{}/v1'.format(port)
+    if args.in_flight is not None:
+        os.environ['PN_MAX_IN_FLIGHT'] = str(args.in_flight)
+
+
+class StubTaskcluster(object):
+    """Serves task definitions, logs and buildbot properties the way the Taskcluster queue does"""
+
+    def __init__(self, port, task_latency, log_latency, log_size):
+        self.port = port
+        self.task_latency = task_latency
+        self.log_latency = log_latency
+        self.log_line = b'[task 2017-03-02T17:58:31.000Z] benchmark log line, nothing to see here\n'
+        self.log_size = log_size
+        self.tasks = {}
+        self.requests = Counter()
+        self.handler = None
+        self.server = None
+
+    async def start(self, loop):
+        from aiohttp import web
+        self.app = web.Application(loop=loop)
+        self.app.router.add_route('GET', '/v1/task/{task_id}', self.task)
+        self.app.router.add_route('GET', '/v1/task/{task_id}/runs/{run_id}/artifacts/public/logs/live.log', self.log)
+        self.app.router.add_route('GET', '/v1/task/{task_id}/runs/{run_id}/artifacts/public/properties.json',
+                                  self.properties)
+        self.app.router.add_route('GET', '/logs/{task_id}/{run_id}', self.bbb_log)
+        self.handler = self.app.make_handler()
+        self.server = await loop.create_server(self.handler, '127.0.0.1', self.port)
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.app.shutdown()
+        await self.handler.shutdown(1)
+        await self.app.cleanup()
+
+    async def task(self, request):
+        from aiohttp import web
+        self.requests['task'] += 1
+        await asyncio.sleep(self.task_latency)
+        definition = self.tasks.get(request.match_info['task_id'])
+        if definition is None:
+            return web.Response(status=404, text='{"code": "ResourceNotFound"}', content_type='application/json')
+        return web.Response(text=json.dumps(definition), content_type='application/json')
+
+    async def properties(self, request):
+        from aiohttp import web
+        self.requests['properties'] += 1
+        await asyncio.sleep(self.task_latency)
+        log_url = 'http://127.0.0.1:{port}/logs/{task_id}/{run_id}'.format(port=self.port, **request.match_info)
+        body = {'log_url': [log_url]}
+        return web.Response(text=json.dumps(body), content_type='application/json')
+
+    async def bbb_log(self, request):
+        #  The actual log of a buildbot-bridge task, linked from its properties
+        self.requests['bbb_log'] += 1
+        return await self.log(request, counted=True)
+
+    async def log(self, request, counted=False):
+        from aiohttp import web
+        if not counted:
+            self.requests['log'] += 1
+        await asyncio.sleep(self.log_latency)
+        response = web.StreamResponse(headers={'Content-Type': 'text/plain'})
+        await response.prepare(request)
+        chunk = self.log_line * (64 * 1024 // len(self.log_line))
+        remaining = self.log_size
+        while remaining > 0:
+            response.write(chunk[:remaining])
+            remaining -= len(chunk)
+            await response.drain()
+        await response.write_eof()
+        return response
+
+
+class StubAWSClient(object):
+    """
+    Stands in for a boto3 client. Every API call blocks the calling executor thread for the configured latency, like
+    a round trip to AWS would, and returns just enough of a response for the plugins.
+    """
+    RESPONSES = {
+        'create_multipart_upload': {'UploadId': 'benchmark-upload'},
+        'upload_part': {'ETag': '"benchmark-etag"'},
+        'abort_multipart_upload': {},
+        'send_raw_email': {'MessageId': 'benchmark-message'},
+        'publish': {'MessageId': 'benchmark-message'},
+    }
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._objects = set()
+
+    def head_object(self, Bucket, Key):
+        from botocore.exceptions import ClientError
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls['head_object'] += 1
+            exists = Key in self._objects
+        if not exists:
+            raise ClientError({'Error': {'Code': '404'}, 'ResponseMetadata': {'HTTPStatusCode': 404}}, 'HeadObject')
+        return {'ContentLength': 0}
+
+    def put_object(self, Bucket, Key, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls['put_object'] += 1
+            self._objects.add(Key)
+        return {}
+
+    def complete_multipart_upload(self, Bucket, Key, **kwargs):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls['complete_multipart_upload'] += 1
+            self._objects.add(Key)
+        return {}
+
+    def __getattr__(self, name):
+        if name not in self.RESPONSES:
+            raise AttributeError(name)
+
+        def call(**kwargs):
+            time.sleep(self.latency)
+            with self._lock:
+                self.calls[name] += 1
+            return dict(self.RESPONSES[name])
+        return call
+
+
+class StubSMTP(object):
+    """Stands in for a logged in smtplib.SMTP session"""
+
+    def __init__(self, latency, calls, lock):
+        self.latency = latency
+        self.calls = calls
+        self._lock = lock
+
+    def noop(self):
+        return 250, b'OK'
+
+    def sendmail(self, from_addr, to_addrs, message):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls['sendmail'] += 1
+        return {}
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RecordingProtocol(object):
+    """
+    Collects the lines the IRC client writes instead of sending them to a server, and answers like a server would: the
+    registration is accepted and every JOIN is echoed back.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.nick = None
+        self.lines = []
+
+    def write(self, message):
+        self.lines.append(message)
+        command, _, params = message.strip().partition(' ')
+        if command == 'NICK':
+            self.nick = params
+        elif command == 'USER':
+            self.client.trigger('RPL_WELCOME', message='Welcome to the benchmark')
+        elif command == 'JOIN':
+            for channel in params.split(' ')[0].split(','):
+                self.client.trigger('JOIN', nick=self.nick, user=self.nick, host='localhost', channel=channel)
+
+    def close(self):
+        pass
+
+
+def stub_irc_client():
+    import bottom
+
+    class StubIRCClient(bottom.Client):
+        async def connect(self):
+            self.protocol = RecordingProtocol(self)
+            self.trigger('CLIENT_CONNECT')
+
+    return StubIRCClient
+
+
+class FakeChannel(object):
+    """The parts of an aioamqp channel the consumer uses"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.acked = {}
+        self.requeued = {}
+        self.done = asyncio.Event(loop=loop)
+        self.expected = 0
+
+    async def basic_client_ack(self, delivery_tag):
+        self.acked[delivery_tag] = self.loop.time()
+        self.check_done()
+
+    async def basic_client_nack(self, delivery_tag, multiple=False, requeue=True):
+        #  Requeued messages are not delivered again, they count as done
+        self.requeued[delivery_tag] = self.loop.time()
+        self.check_done()
+
+    def check_done(self):
+        if len(self.acked) + len(self.requeued) >= self.expected:
+            self.done.set()
+
+
+def load_messages(args, taskcluster):
+    with open(args.corpus) as f:
+        corpus = json.load(f)
+
+    messages = []
+    for i in range(args.messages):
+        recorded = corpus[i % len(corpus)]
+        body = json.loads(json.dumps(recorded['message']))
+        if not args.repeat_tasks:
+            #  Each replayed message is about a different task, so the task cache doesn't hide the fetches
+            body['status']['taskId'] = '{}-{}'.format(body['status']['taskId'], i)
+        taskcluster.tasks[body['status']['taskId']] = recorded['task']
+        messages.append((recorded['exchange'], json.dumps(body).encode('utf-8')))
+    return messages
+
+
+def percentile(sorted_values, fraction):
+    #  Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def format_counts(counts):
+    return ', '.join('{}={}'.format(name, count) for name, count in sorted(counts.items()))
+
+
+def record_completions(consumer, loop):
+    #  Wraps the send of every plugin queue to record, per delivery tag, when the last notification of the message was
+    #  sent (or spooled)
+    completed = {}
+    for plugin_queue in consumer.plugin_queues.values():
+        async def timed_send(plugin_name, task_data, *args, send=plugin_queue.send):
+            try:
+                await send(plugin_name, task_data, *args)
+            finally:
+                delivery_tag = task_data.envelope.delivery_tag
+                completed[delivery_tag] = max(completed.get(delivery_tag, 0), loop.time())
+        plugin_queue.send = timed_send
+    return completed
+
+
+async def replay(consumer, channel, messages):
+    from aioamqp.envelope import Envelope
+    from aioamqp.properties import Properties
+
+    completed = record_completions(consumer, channel.loop)
+    dispatched = {}
+    channel.expected = len(messages)
+    started = channel.loop.time()
+    for delivery_tag, (exchange, body) in enumerate(messages, start=1):
+        envelope = Envelope('benchmark', delivery_tag, exchange, 'route.benchmark', False)
+        dispatched[delivery_tag] = channel.loop.time()
+        await consumer.dispatch(channel, body, envelope, Properties())
+    await channel.done.wait()
+    await consumer.drain()
+    elapsed = channel.loop.time() - started
+    #  A message is done once it is acknowledged (or requeued) and all its notifications are sent, whichever comes last
+    finished = dict(channel.requeued)
+    finished.update(channel.acked)
+    latencies = sorted(max(finished[tag], completed.get(tag, 0)) - dispatched[tag] for tag in dispatched)
+    return elapsed, latencies
+
+
+def main():
+    args = parse_args()
+    #  Identity configurations are looked up relative to the repository root
+    os.chdir(os.path.dirname(HERE))
+    port = free_port()
+    configure_environment(args, port)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+                        level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    #  The IRC client is created and connected when the plugin is constructed, so it has to be replaced before the
+    #  consumer is created
+    import pulsenotify.plugins.irc
+    pulsenotify.plugins.irc.Client = stub_irc_client()
+
+    from pulsenotify import event_loop
+    from pulsenotify.consumer import NotifyConsumer
+
+    taskcluster = StubTaskcluster(port, args.task_latency, args.log_latency, args.log_size)
+    event_loop.run_until_complete(taskcluster.start(event_loop))
+
+    consumer = NotifyConsumer()
+    aws_clients = {}
+    for name in ('log_collect', 'ses', 'sns'):
+        if name in consumer.notifiers:
+            aws_clients[name] = consumer.notifiers[name].client = StubAWSClient(args.sink_latency)
+    smtp_calls, smtp_lock = Counter(), threading.Lock()
+    if 'smtp' in consumer.notifiers:
+        consumer.notifiers['smtp'].pool.connect = lambda: StubSMTP(args.sink_latency, smtp_calls, smtp_lock)
+
+    messages = load_messages(args, taskcluster)
+    channel = FakeChannel(event_loop)
+    try:
+        elapsed, latencies = event_loop.run_until_complete(replay(consumer, channel, messages))
+    finally:
+        event_loop.run_until_complete(consumer.shutdown())
+        event_loop.run_until_complete(taskcluster.close())
+
+    #  ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+
+    print('messages:        {}'.format(len(messages)))
+    print('max in flight:   {}'.format(consumer.max_in_flight))
+    print('elapsed:         {:.2f}s'.format(elapsed))
+    print('throughput:      {:.1f} messages/s'.format(len(messages) / elapsed if elapsed else 0.0))
+    print('latency p50:     {:.1f}ms'.format(p50 * 1000))
+    print('latency p99:     {:.1f}ms'.format(p99 * 1000))
+    print('peak RSS:        {:.1f}MB'.format(peak_rss))
+    print('requeued:        {}'.format(len(channel.requeued)))
+    print('taskcluster:     {}'.format(format_counts(taskcluster.requests)))
+    for name, client in sorted(aws_clients.items()):
+        print('{:<16} {}'.format(name + ':', format_counts(client.calls)))
+    if smtp_calls:
+        print('smtp:            sendmail={}'.format(smtp_calls['sendmail']))
+
+    #  The logs of buildbot-bridge tasks are found through their properties. When none are fetched, the replay didn't
+    #  exercise that path and its numbers are not comparable.
+    bbb_tasks = sum(1 for task in taskcluster.tasks.values() if task.get('provisionerId') == 'buildbot-bridge')
+    bbb_logs = taskcluster.requests['bbb_log']
+    if bbb_tasks and (bbb_logs == 0 or bbb_logs < taskcluster.requests['properties']):
+        print('only {} of {} buildbot-bridge logs were fetched'.format(bbb_logs, taskcluster.requests['properties']))
+        return 1
+    if args.max_p99 is not None and p99 > args.max_p99:
+        print('p99 latency {:.3f}s is above the {:.3f}s budget'.format(p99, args.max_p99))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
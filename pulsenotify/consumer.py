@@ -1,12 +1,22 @@
+import asyncio
+import itertools
 import json
 import logging
 import os
+from collections import OrderedDict
+from time import monotonic
 from importlib import import_module
 from yaml import safe_load
 from json import JSONDecodeError
-import aiohttp
+from aioamqp.envelope import Envelope
 from pulsenotify.util import fetch_task, retry_connection, RetriesExceededError
-from pulsenotify.util import async_time_me
+from pulsenotify.util import async_time_me, create_http_session, executor, TaskCache, QUEUE_URL
+from pulsenotify.util import circuit_breaker, endpoint_of, failed_permanently, CircuitOpenError
+from pulsenotify.plugins import LOGS_NONE, LOGS_URLS
+from pulsenotify import metrics
+from pulsenotify.metrics import influxdb_sink, MessageTimings
+from pulsenotify.spool import RetrySpool, SPOOL_PATH
+from pulsenotify.dedup import DedupIndex, DEDUP_PATH
 
 log = logging.getLogger(__name__)
 
@@ -24,6 +34,19 @@ EXCHANGES = {
 #  Keys to bind exchanges to
 ROUTING_KEYS = os.environ['ROUTING_KEYS'].split(':')
 
+#  Maximum number of Pulse messages being dispatched at the same time
+MAX_IN_FLIGHT = int(os.environ.get('PN_MAX_IN_FLIGHT', 10))
+
+#  Maximum number of runs of a single task whose logs are looked up at the same time
+LOG_FETCH_CONCURRENCY = int(os.environ.get('PN_LOG_FETCH_CONCURRENCY', 4))
+
+#  Maximum number of notifications waiting to be sent by each plugin. When a plugin's queue is full, consumption of
+#  Pulse messages is paused until the queue is half empty again.
+PLUGIN_QUEUE_SIZE = int(os.environ.get('PN_PLUGIN_QUEUE_SIZE', 100))
+
+#  Seconds a message may spend retrying Taskcluster requests, counted from when it was received
+MESSAGE_DEADLINE = float(os.environ.get('PN_MESSAGE_DEADLINE', 60))
+
 
 class TaskFetchFailedError(Exception):
     """ Exception thrown when task fetch fails """
@@ -50,9 +73,71 @@ class InvalidStatusConfigurationError(Exception):
     pass
 
 
+class PluginQueue(object):
+    """
+    Bounded queue of the notifications to send with one plugin, and the pool of workers sending them.
+
+    Messages put their notifications in the queues of the plugins involved and are acknowledged once every
+    notification has been queued, so a slow plugin only delays its own notifications. put waits while the queue is
+    full. on_full and on_drained are called when the queue fills up and when it is back under half full.
+    """
+    def __init__(self, name, send, workers, maxsize=PLUGIN_QUEUE_SIZE, on_full=None, on_drained=None):
+        self.name = name
+        self.send = send
+        self.workers = workers
+        self.maxsize = maxsize
+        self.on_full = on_full
+        self.on_drained = on_drained
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._workers = []
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def full(self):
+        return self._queue.full()
+
+    def below_low_watermark(self):
+        return self._queue.qsize() <= self.maxsize // 2
+
+    async def put(self, *args):
+        #  Workers are started with the first notification, so the queue can be created before the event loop runs
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+        if self._queue.full() and self.on_full is not None:
+            self.on_full(self)
+        await self._queue.put(args)
+        metrics.plugin_queue_size.set(self._queue.qsize(), plugin=self.name)
+
+    async def work(self):
+        while True:
+            args = await self._queue.get()
+            try:
+                await self.send(*args)
+            except Exception as e:
+                log.exception('Unexpected error sending %s notification: %s', self.name, e)
+            finally:
+                self._queue.task_done()
+                metrics.plugin_queue_size.set(self._queue.qsize(), plugin=self.name)
+                if self.on_drained is not None and self.below_low_watermark():
+                    self.on_drained(self)
+
+    async def join(self):
+        #  Waits for every queued notification to be sent
+        await self._queue.join()
+
+    async def close(self):
+        await self.join()
+        for worker in self._workers:
+            worker.cancel()
+        if self._workers:
+            await asyncio.wait(self._workers)
+        self._workers = []
+
+
 class NotifyConsumer(object):
 
-    def __init__(self):
+    def __init__(self, worker_id=None):
         #  Initializing the consumer means creating the mapping for the notification plugins.
         #  The list of plugins to use is pulled from the environment config (colon separated).
         #  The Plugin objects are constructed by importing the name from the plugins module and adding to
@@ -80,10 +165,69 @@ class NotifyConsumer(object):
         #  information to the list. When the notification configurations are created, the default configuration will
         #  always be added to the list with no overwriting.
         self.identities = {**{'default': {}}, **self.identities}
+        self.identities = self.compile_identities(self.identities)
 
         log.debug('IDs: %s', ', '.join(self.identities.keys()))
+
+        #  Messages are processed concurrently, up to max_in_flight at a time. The semaphore bounds the window of
+        #  outstanding messages and the set keeps track of their tasks so they can be waited on at shutdown.
+        self.max_in_flight = MAX_IN_FLIGHT
+        self._in_flight_slots = asyncio.Semaphore(self.max_in_flight)
+        self._in_flight = set()
+
+        #  Notifications handed to a plugin that sends them in batches, waiting for their batch to be sent
+        self._batched = set()
+
+        #  Each plugin has a queue of notifications to send, sent by max_concurrency workers. The number of workers
+        #  can be overridden for a plugin with PN_<PLUGIN>_CONCURRENCY (ie PN_SES_CONCURRENCY).
+        self.plugin_queues = {}
+        for name, plugin in self.notifiers.items():
+            workers = int(os.environ.get('PN_{}_CONCURRENCY'.format(name.upper()), plugin.max_concurrency))
+            self.plugin_queues[name] = PluginQueue(name, self.notify_plugin, workers,
+                                                   on_full=self.pause, on_drained=self.resume)
+
+        #  Set by the worker to stop and restart the delivery of messages when a plugin queue is full, or for a while
+        #  when Taskcluster is down. Consumption is never restarted once shutdown has begun.
+        self.consumption = None
+        self.paused = False
+        self.holding_off = False
+        self.stopping = False
+
+        #  All Taskcluster requests made while processing messages share a single pooled HTTP session
+        self.http_session = create_http_session()
+
+        #  Task definitions are shared between the messages about the same task
+        self.task_cache = TaskCache()
+
+        #  Notifications a plugin gave up on are kept on disk and retried in the background, see start. Each worker
+        #  process of a supervisor has its own spool, so a notification is only retried by one of them.
+        self.worker_id = worker_id
+        self.spool = RetrySpool(SPOOL_PATH if worker_id is None else '{}.{}'.format(SPOOL_PATH, worker_id))
+
+        #  Messages delivered again by Pulse are skipped. The index is saved per worker process, like the spool.
+        if DEDUP_PATH is not None and worker_id is not None:
+            self.dedup = DedupIndex('{}.{}'.format(DEDUP_PATH, worker_id))
+        else:
+            self.dedup = DedupIndex(DEDUP_PATH)
+
+        metrics.in_flight_messages.set_function(lambda: len(self._in_flight))
+
         log.info('Consumer initialized.')
 
+    def compile_identities(self, identities):
+        #  Identities are checked and normalized once at startup, so resolving the configurations of a message only
+        #  costs a lookup per id referenced by the task
+        compiled = {}
+        for id_name, id_config in identities.items():
+            id_config = dict(id_config or {})
+            if 'plugins' in id_config:
+                id_config['plugins'] = tuple(id_config['plugins'] or ())
+                unknown_plugins = [p for p in id_config['plugins'] if p not in self.notifiers]
+                if unknown_plugins:
+                    log.warning('ID %s uses plugins that are not enabled: %s', id_name, ', '.join(unknown_plugins))
+            compiled[id_name] = id_config
+        return compiled
+
     @property
     def exchanges(self):
         return EXCHANGES
@@ -92,15 +236,131 @@ class NotifyConsumer(object):
     def routing_keys(self):
         return ROUTING_KEYS
 
-    @async_time_me
     async def dispatch(self, channel, body, envelope, properties):
-        task_data = TaskData(body, envelope, properties)
+        #  aioamqp awaits this callback before reading the next frame from the connection, so the message is handed
+        #  off to its own task and the callback returns as soon as there is room in the in-flight window.
+        received_at = monotonic()
+        metrics.messages_consumed.inc()
+        await self._in_flight_slots.acquire()
+        task = asyncio.ensure_future(self.process(channel, body, envelope, properties, received_at))
+        self._in_flight.add(task)
+        task.add_done_callback(self._process_done)
+
+    def _process_done(self, task):
+        self._in_flight.discard(task)
+        self._in_flight_slots.release()
+
+    def start(self):
+        #  Starts retrying the spooled notifications, including the ones left over from a previous run
+        self.spool.start(self.redeliver)
+
+    def pause(self, plugin_queue):
+        #  Stops the delivery of new messages while a plugin can't keep up. Messages already delivered keep being
+        #  processed, and wait for room in the queue.
+        if self.paused or self.stopping or self.consumption is None:
+            return
+        log.warning('%s queue is full, pausing consumption', plugin_queue.name)
+        self.paused = True
+        metrics.consumption_paused.set(1)
+        asyncio.ensure_future(self.consumption.stop())
+
+    def resume(self, plugin_queue):
+        #  Queues drained during shutdown must not start consuming again
+        if self.stopping:
+            return
+        if not self.paused or not all(q.below_low_watermark() for q in self.plugin_queues.values()):
+            return
+        self.paused = False
+        if self.holding_off:
+            return
+        log.info('Plugin queues drained, resuming consumption')
+        metrics.consumption_paused.set(0)
+        asyncio.ensure_future(self.consumption.start())
+
+    def hold_off(self, delay):
+        #  Stops the delivery of new messages for delay seconds while an endpoint every message needs is down, instead
+        #  of receiving messages only to requeue them
+        if self.holding_off or self.stopping or self.consumption is None:
+            return
+        delay = max(delay, 1)
+        log.warning('Pausing consumption for %.0fs', delay)
+        self.holding_off = True
+        metrics.consumption_paused.set(1)
+        asyncio.ensure_future(self.consumption.stop())
+        asyncio.get_event_loop().call_later(delay, self.end_hold_off)
+
+    def end_hold_off(self):
+        self.holding_off = False
+        if self.paused or self.stopping:
+            return
+        log.info('Resuming consumption')
+        metrics.consumption_paused.set(0)
+        asyncio.ensure_future(self.consumption.start())
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    async def drain(self):
+        #  Wait for every message currently being processed to be acknowledged, and their notifications to be sent
+        if self._in_flight:
+            log.info('Waiting for %s in-flight messages to complete', len(self._in_flight))
+            await asyncio.wait(list(self._in_flight))
+        for plugin_queue in self.plugin_queues.values():
+            await plugin_queue.join()
+
+    async def shutdown(self):
+        #  Stop consuming and finish processing the messages already received, then let the plugins send what they
+        #  batched and close their connections, release the HTTP connection pool and the threads used for blocking
+        #  calls, and write the remaining metrics
+        self.stopping = True
+        if self.consumption is not None:
+            try:
+                await self.consumption.stop()
+            except Exception as e:
+                log.warning('Could not stop consuming: %s', e)
+        await self.drain()
+        for plugin_queue in self.plugin_queues.values():
+            await plugin_queue.close()
+        for plugin in self.notifiers.values():
+            await plugin.close()
+        if self._batched:
+            await asyncio.wait(list(self._batched))
+        await self.spool.close()
+        self.dedup.save()
+        self.http_session.close()
+        executor.shutdown(wait=True)
+        await influxdb_sink.close()
+        log.info('Consumer shut down. Task cache hits: %s, misses: %s', self.task_cache.hits, self.task_cache.misses)
+
+    @async_time_me
+    async def process(self, channel, body, envelope, properties, received_at=None):
+        task_data = TaskData(body, envelope, properties, received_at)
+        if received_at is not None:
+            task_data.timings.record('receive', monotonic() - received_at)
+        requeue = False
+        processed = False
 
         try:
-            await task_data.fetch_task_and_analyze()
+            #  Duplicates are acknowledged without fetching anything
+            if self.dedup.seen(task_data.dedup_key):
+                metrics.duplicate_messages.inc()
+                log.info('Skipping duplicate message for %r run %s', task_data, task_data.run_id)
+                return
+
+            with task_data.timings.stage('fetch_task'):
+                await task_data.fetch_task_and_analyze(self.http_session, self.task_cache)
 
-            notify_sections = self.generate_notification_configurations(task_data)
+            with task_data.timings.stage('generate_notification_configurations'):
+                notify_sections = self.generate_notification_configurations(task_data)
 
+            #  Only look up as much of the logs as the plugins about to be notified need
+            with task_data.timings.stage('fetch_logs'):
+                await task_data.fetch_logs(self.logs_required(notify_sections))
+
+            #  The notifications are handed to the queue of each plugin and sent by its workers, so plugins are notified
+            #  at the same time and a slow plugin doesn't hold up the others. The message is acknowledged once all its
+            #  notifications are queued, they are kept in the spool until they are sent.
             for id_name, id_section in notify_sections.items():
                 if 'plugins' in id_section:
                     enabled_plugins = id_section['plugins']
@@ -110,9 +370,11 @@ class NotifyConsumer(object):
 
                 for plugin_name in enabled_plugins:
                     if plugin_name in self.notifiers:
-                        await self.notifiers[plugin_name].notify(task_data, id_section)
+                        with task_data.timings.stage('queue:' + plugin_name):
+                            await self.queue_notification(plugin_name, task_data, id_section)
                     else:
                         log.warn('No plugin object %s for %r found in consumer.notifiers', plugin_name, task_data)
+            processed = True
 
         except NoNotificationConfigurationError:
             log.exception('%s has no notifications section.', task_data)
@@ -128,6 +390,12 @@ class NotifyConsumer(object):
         except TaskFetchFailedError:
             log.exception('Could not fetch %r', task_data)
 
+        except CircuitOpenError as e:
+            #  Taskcluster is down: the message goes back to the queue to be processed once it is back
+            log.warning('Requeuing %r: %s', task_data, e)
+            requeue = True
+            self.hold_off(e.retry_after)
+
         except NoLogsExistError as e:
             # Cancelled tasks may not have logs if they have never started. This happens when
             # we have to cancel a release graph. Hence, log.exception() is too high for this case.
@@ -137,8 +405,105 @@ class NotifyConsumer(object):
             log.exception('Exception %s caught by generic exception trap', e)
 
         finally:
-            log.info('Acknowledging consumption of %r', task_data)
-            return await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+            #  Only messages whose notifications were all queued are skipped when delivered again
+            if processed:
+                self.dedup.add(task_data.dedup_key)
+            if requeue:
+                with task_data.timings.stage('ack'):
+                    await channel.basic_client_nack(delivery_tag=envelope.delivery_tag, requeue=True)
+                metrics.messages_requeued.inc()
+            else:
+                log.info('Acknowledging consumption of %r', task_data)
+                with task_data.timings.stage('ack'):
+                    await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+                metrics.messages_acked.inc()
+            log.debug('Timings for %r: %s', task_data, task_data.timings)
+
+    async def queue_notification(self, plugin_name, task_data, id_section):
+        #  The notification is kept in the spool while it is queued, so it is sent after a restart if the worker dies
+        #  before sending it. When it can't be, it is still queued, and only spooled if it fails.
+        try:
+            delivery_id = await self.spool.enqueue(plugin_name, {'task': task_data.to_record(), 'config': id_section})
+        except Exception as e:
+            log.exception('Could not spool %s notification for %r: %s', plugin_name, task_data, e)
+            delivery_id = None
+        await self.plugin_queues[plugin_name].put(plugin_name, task_data, id_section, delivery_id)
+
+    async def notify_plugin(self, plugin_name, task_data, id_section, delivery_id=None):
+        #  Run by the workers of the plugin's queue. A failed notification is left in the spool to be retried later.
+        try:
+            with task_data.timings.stage('notify:' + plugin_name):
+                sent = await self.notifiers[plugin_name].notify(task_data, id_section)
+        except Exception as e:
+            await self.notification_failed(plugin_name, task_data, id_section, delivery_id, e)
+            return
+
+        if isinstance(sent, asyncio.Future):
+            #  The plugin batches notifications and sends this one later. It stays in the spool until then, and the
+            #  worker moves on to the next notification.
+            waiting = asyncio.ensure_future(self.wait_batched(plugin_name, task_data, id_section, delivery_id, sent))
+            self._batched.add(waiting)
+            waiting.add_done_callback(self._batched.discard)
+        else:
+            await self.notification_sent(plugin_name, task_data, delivery_id)
+
+    async def wait_batched(self, plugin_name, task_data, id_section, delivery_id, sent):
+        try:
+            await sent
+        except Exception as e:
+            await self.notification_failed(plugin_name, task_data, id_section, delivery_id, e)
+        else:
+            await self.notification_sent(plugin_name, task_data, delivery_id)
+
+    async def notification_sent(self, plugin_name, task_data, delivery_id):
+        metrics.notifications.inc(plugin=plugin_name, result='sent')
+        await self.unspool_notification(plugin_name, task_data, delivery_id)
+
+    async def notification_failed(self, plugin_name, task_data, id_section, delivery_id, error):
+        metrics.notifications.inc(plugin=plugin_name, result='failed')
+        log.exception('%s plugin failed to notify for %r: %s', plugin_name, task_data, error)
+        if failed_permanently(error):
+            #  Retrying from the spool would fail the same way
+            log.error('Not spooling %s notification for %r, it failed permanently', plugin_name, task_data)
+            metrics.spooled_notifications.inc(plugin=plugin_name, result='dropped')
+            await self.unspool_notification(plugin_name, task_data, delivery_id)
+        else:
+            await self.spool_notification(plugin_name, task_data, id_section, delivery_id, error)
+
+    async def spool_notification(self, plugin_name, task_data, id_section, delivery_id, error):
+        try:
+            if delivery_id is None:
+                await self.spool.add(plugin_name, {'task': task_data.to_record(), 'config': id_section}, repr(error))
+            else:
+                await self.spool.failed(delivery_id, plugin_name, repr(error))
+        except Exception as e:
+            log.exception('Could not spool %s notification for %r: %s', plugin_name, task_data, e)
+
+    async def unspool_notification(self, plugin_name, task_data, delivery_id):
+        #  A notification that could not be removed from the spool is sent again after a restart
+        if delivery_id is None:
+            return
+        try:
+            await self.spool.remove(delivery_id)
+        except Exception as e:
+            log.exception('Could not remove %s notification for %r from the spool: %s', plugin_name, task_data, e)
+
+    async def redeliver(self, plugin_name, entry):
+        #  Notifies a plugin again for a spooled notification, with the task and logs as they were when it failed
+        if plugin_name not in self.notifiers:
+            log.warn('Plugin %s is not enabled anymore, dropping its spooled notification', plugin_name)
+            return
+
+        task_data = TaskData.from_record(entry['task'], self.http_session)
+        with task_data.timings.stage('notify:' + plugin_name):
+            await self.notifiers[plugin_name].notify(task_data, entry['config'])
+        metrics.notifications.inc(plugin=plugin_name, result='sent')
+
+    def logs_required(self, notify_sections):
+        return max((self.notifiers[plugin_name].logs_required
+                    for id_section in notify_sections.values()
+                    for plugin_name in id_section.get('plugins', ())
+                    if plugin_name in self.notifiers), default=LOGS_NONE)
 
     def generate_notification_configurations(self, task_data):
         #  Retrieve the notifications section out of the task
@@ -166,12 +531,14 @@ class NotifyConsumer(object):
         #  present in both the original configuration and the service's list of ids, we create a notification
         #  configuration and add it to the mapping. We also always add the 'default' id to the mapping in case the user
         #  has already configured notifications in the task without ids.
-        ids_in_original_config = original_configuration.get('ids', {})
-        return {
-                id_name: {**original_configuration, **id_config}
-                for id_name, id_config in self.identities.items()
-                if id_name in ids_in_original_config or id_name is 'default'
-        }
+        notify_sections = OrderedDict()
+        for id_name in itertools.chain(('default',), original_configuration.get('ids', ())):
+            id_config = self.identities.get(id_name)
+            if id_config is None:
+                log.debug('Unknown id %s in %r', id_name, task_data)
+                continue
+            notify_sections[id_name] = {**original_configuration, **id_config}
+        return notify_sections
 
 
 class TaskData(object):
@@ -180,64 +547,123 @@ class TaskData(object):
     S3_KEY_TEMPLATE = '{branch}/{product}-{version}/build{build_number}/{name}-{platform}-{task_id}-{run_id}'
     LOG_TEMPLATES = {
         'buildbot-bridge':
-            'https://queue.taskcluster.net/v1/task/{task_id}/runs/{run_id}/artifacts/public/properties.json',
+            QUEUE_URL + '/task/{task_id}/runs/{run_id}/artifacts/public/properties.json',
 
         'aws-provisioner-v1':
-            'https://queue.taskcluster.net/v1/task/{task_id}/runs/{run_id}/artifacts/public/logs/live.log',
+            QUEUE_URL + '/task/{task_id}/runs/{run_id}/artifacts/public/logs/live.log',
     }
 
-    def __init__(self, body, envelope, properties):
+    def __init__(self, body, envelope, properties, received_at=None):
         self.body = json.loads(body.decode("utf-8"))
         self.envelope = envelope
         self.properties = properties
         self.id = self.body['status']['taskId']
         self.provisioner_id = self.body['status']['provisionerId']
         self.task_group_id = self.body['status']['taskGroupId']
+        self.run_id = self.body.get('runId')
         self.status = envelope.exchange_name.split('/')[-1]
         self.inspector_url = "https://tools.taskcluster.net/task-inspector/#{task_id}".format(task_id=self.id)
+        self.timings = MessageTimings(status=self.status, provisioner=self.provisioner_id)
+        self.deadline = (received_at if received_at is not None else monotonic()) + MESSAGE_DEADLINE
 
-        #  These fields are created by the async function fetch_task_and_analyze
+        #  Set on tasks rebuilt from the retry spool
+        self.spooled = False
+
+        #  These fields are created by the async functions fetch_task_and_analyze and fetch_logs
         self.definition = None
         self.logs = None
+        self.session = None
 
     def __repr__(self):
         return "Task(id={id}, status={status})".format(id=self.id, status=self.status)
 
-    async def fetch_task_and_analyze(self):
+    @property
+    def dedup_key(self):
+        return self.id, self.run_id, self.envelope.exchange_name
+
+    def to_record(self):
+        #  JSON serializable state of a task once fetched, enough to notify for it again later
+        return {
+            'body': self.body,
+            'exchange': self.envelope.exchange_name,
+            'definition': self.definition,
+            'logs': self.logs,
+        }
+
+    @classmethod
+    def from_record(cls, record, session=None):
+        envelope = Envelope(consumer_tag=None, delivery_tag=None, exchange_name=record['exchange'],
+                            routing_key=None, is_redeliver=True)
+        task_data = cls(json.dumps(record['body']).encode('utf-8'), envelope, None)
+        task_data.definition = record['definition']
+        if record['logs'] is not None:
+            task_data.logs = [tuple(run_log) for run_log in record['logs']]
+        task_data.session = session
+        task_data.spooled = True
+        return task_data
+
+    async def fetch_task_and_analyze(self, session=None, task_cache=None):
         #  Fetch task, retrying a few times in case of a timeout
         #  Once the task is fetched, set as the definition and get the provisionerId
+        #  The definition may come from (and is shared with) the task cache, so it must not be modified
+        self.session = session
+        fetch = task_cache.fetch_task if task_cache is not None else fetch_task
         try:
-            self.definition = await retry_connection(fetch_task, self.id)
+            self.definition = await retry_connection(fetch, self.id, session, deadline=self.deadline)
         except RetriesExceededError as e:
             raise TaskFetchFailedError from e
 
-        #  No need to create the logs if the provisionerId is not supported
-        if self.provisioner_id not in self.LOG_TEMPLATES:
+    async def fetch_logs(self, logs_required):
+        #  No need to create the logs if no plugin uses them or the provisionerId is not supported
+        if logs_required == LOGS_NONE or self.provisioner_id not in self.LOG_TEMPLATES:
             return
 
-        #  Download the logs and store them in this object
-        self.logs = []
-        for run in self.body['status']['runs']:
-            url = self.LOG_TEMPLATES[self.provisioner_id].format(task_id=self.id, run_id=run['runId'])
-            #  Retry log grab in case of network instability
+        #  Plugins that only link to the logs need nothing more than the runs of the task
+        if logs_required == LOGS_URLS:
+            self.logs = [(run['runId'], None,) for run in self.body['status']['runs']]
+            return
+
+        #  Find where each run's log can be downloaded from and store it in this object. The log contents are not
+        #  downloaded here, plugins that need them stream them from the source url with open_log.
+        #  Runs are looked up concurrently so one slow or failing run doesn't hold up the others.
+        runs = self.body['status']['runs']
+        limit = asyncio.Semaphore(LOG_FETCH_CONCURRENCY)
+        results = await asyncio.gather(*[self.resolve_run_log(run, limit) for run in runs], return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        self.logs = [(run['runId'], source_url,) for run, source_url in zip(runs, results) if source_url is not None]
+
+    async def resolve_run_log(self, run, limit):
+        url = self.LOG_TEMPLATES[self.provisioner_id].format(task_id=self.id, run_id=run['runId'])
+        async with limit:
+            #  Retry log lookup in case of network instability
             try:
-                # NoLogsExistError is raised only when we're sure the logs won't ever exist
-                task_log = await retry_connection(
-                    get_log, url, self.provisioner_id, by_pass_exceptions=(NoLogsExistError,)
-                )
-                self.logs.append((run['runId'], task_log,))
+                with self.timings.stage('get_log'):
+                    # NoLogsExistError is raised only when we're sure the logs won't ever exist
+                    return await retry_connection(
+                        resolve_log_url, url, self.provisioner_id, self.session, by_pass_exceptions=(NoLogsExistError,),
+                        deadline=self.deadline,
+                    )
             except RetriesExceededError:
                 log.warn('Could not retrieve log for %r run %s.', self, run)
-                continue
+                return None
+
+    def open_log(self, source_url):
+        #  Returns the response context manager for a log, to be read in chunks with response.content
+        return self.session.get(source_url)
 
     def log_data(self):
         build_properties = self.definition.get('extra', {}).get('build_props')
         if not build_properties:
             build_properties = self.definition.get('payload', {}).get('properties')
         if build_properties and self.logs and ('branch' in build_properties or 'repo_path' in build_properties):
-            for run_number, data in self.logs:
+            for run_number, source_url in self.logs:
                 yield {
-                    'data': data,
+                    'run_id': run_number,
+                    'source_url': source_url,
                     's3_key': self.make_s3_key(run_number, build_properties),
                     'destination_url': self.S3_DESTINATION.format(
                         bucket=os.environ['S3_BUCKET'],
@@ -273,54 +699,36 @@ class TaskData(object):
         return s3_key
 
 
-async def get_log(url, provisioner_id):
-    #  Grabs logs for supported provisionerIds from a given url
+async def resolve_log_url(url, provisioner_id, session):
+    #  Finds the url the log for supported provisionerIds can be downloaded from
     if provisioner_id == 'buildbot-bridge':
-        return await get_bbb_log(url)
+        return await resolve_bbb_log_url(url, session)
 
     elif provisioner_id == 'aws-provisioner-v1':
-        return await get_aws_log(url)
+        return url
 
     else:
-        log.debug('Unknown provisionerId %s given to get_log', provisioner_id)
+        log.debug('Unknown provisionerId %s given to resolve_log_url', provisioner_id)
         return None
 
 
-async def get_aws_log(url):
-    #  Grabs log files for aws-provisioner tasks
-    with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            log.debug('aws response header is: %s', response.headers.get('content-encoding', 'none'))
-            return await response.text()
-
-
-async def get_bbb_log(url):
-    #  Grabs log files for buildbot-bridge provisioner tasks
-    with aiohttp.ClientSession() as session:
+async def resolve_bbb_log_url(url, session):
+    #  buildbot-bridge tasks publish their build properties, which contain the url of the actual log
+    with circuit_breaker(endpoint_of(url)):
         async with session.get(url) as response:
+            response.raise_for_status()
             log.debug('bbb response header is: %s', response.headers.get('content-encoding', 'none'))
             try:
                 json_resp = await response.json()
-                log.debug('bbb actual log filename: %s', json_resp['log_url'][0])
-                async with session.get(json_resp['log_url'][0]) as bbb_response:
-                    log.debug('bbb second response header is: %s',
-                              bbb_response.headers.get('content-encoding', 'none'))
-
-                    try:
-                        test_for_bad_log = await bbb_response.json()
-                        if test_for_bad_log['message'] is 'Artifact not found':
-                            log.debug('Artifact not found at %s', url)
-                            return None
-                    except JSONDecodeError:
-                        pass
-
-                    return await bbb_response.text()
-
             except JSONDecodeError:
                 log.exception('JSONDecodeError thrown when converting buildbot-bridge properties to json.')
                 return None
 
-            except KeyError as e:
-                raise NoLogsExistError(
-                    "Missing key 'log_url' in json response for buildbot-bridge. URL used: {}".format(url)
-                )
+    try:
+        log.debug('bbb actual log filename: %s', json_resp['log_url'][0])
+        return json_resp['log_url'][0]
+
+    except KeyError:
+        raise NoLogsExistError(
+            "Missing key 'log_url' in json response for buildbot-bridge. URL used: {}".format(url)
+        )
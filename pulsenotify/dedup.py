@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+from time import time
+
+log = logging.getLogger(__name__)
+
+#  Messages about the same task run and exchange are skipped for PN_DEDUP_TTL seconds after the first one, keeping
+#  track of the last PN_DEDUP_SIZE messages
+DEDUP_TTL = float(os.environ.get('PN_DEDUP_TTL', 3600))
+DEDUP_SIZE = int(os.environ.get('PN_DEDUP_SIZE', 10000))
+
+#  File the messages already processed are saved to, at most every PN_DEDUP_SAVE_INTERVAL seconds and on shutdown,
+#  and loaded from on startup. Kept in memory only when unset.
+DEDUP_PATH = os.environ.get('PN_DEDUP_PATH')
+DEDUP_SAVE_INTERVAL = float(os.environ.get('PN_DEDUP_SAVE_INTERVAL', 10))
+
+
+class DedupIndex(object):
+    """
+    Bounded, time-windowed index of the Pulse messages already processed.
+
+    Pulse delivers a message again when its acknowledgement was lost, ie after a reconnect. Messages are keyed by
+    (taskId, runId, exchange), and a message whose key was added less than ttl seconds ago is a duplicate. Keys are
+    only added once their message was processed, so a message that failed is processed again when redelivered. Only
+    the last size keys are kept. When path is set, the index is saved at most every save_interval seconds when keys are
+    added, and loaded back on startup, so duplicates are also recognized across a restart or a crash.
+    """
+    def __init__(self, path=DEDUP_PATH, size=DEDUP_SIZE, ttl=DEDUP_TTL, save_interval=DEDUP_SAVE_INTERVAL):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.save_interval = save_interval
+        #  Keys in the order they were added, with when they were added (wall clock time, to survive restarts)
+        self._seen = OrderedDict()
+        self._saved_at = time()
+        if self.path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def seen(self, key):
+        #  Returns whether key was added in the last ttl seconds
+        self.expire(time())
+        return key in self._seen
+
+    def add(self, key):
+        now = time()
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+        if now - self._saved_at >= self.save_interval:
+            self.save()
+
+    def expire(self, now):
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if seen_at + self.ttl > now:
+                return
+            del self._seen[key]
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning('Could not load deduplication index from %s: %s', self.path, e)
+            return
+
+        for key, seen_at in entries[-self.size:]:
+            self._seen[tuple(key)] = seen_at
+        self.expire(time())
+        log.info('Loaded %s processed messages from %s', len(self._seen), self.path)
+
+    def save(self):
+        if self.path is None:
+            return
+        self._saved_at = time()
+        self.expire(self._saved_at)
+        temporary_path = self.path + '.tmp'
+        try:
+            with open(temporary_path, 'w') as f:
+                json.dump(list(self._seen.items()), f)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            log.exception('Could not save deduplication index to %s: %s', self.path, e)
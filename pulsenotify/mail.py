@@ -0,0 +1,196 @@
+import asyncio
+import datetime
+import logging
+import os
+from collections import OrderedDict
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader, TemplateNotFound
+
+log = logging.getLogger(__name__)
+
+#  Template the email plugins render their notifications with
+EMAIL_TEMPLATE = 'email_template.html'
+
+#  Directory compiled templates are cached in, so workers don't compile them again on startup. Templates are compiled
+#  in memory only when unset.
+TEMPLATE_CACHE_DIR = os.environ.get('PN_TEMPLATE_CACHE_DIR')
+
+#  Number of rendered email bodies kept in memory
+RENDER_CACHE_SIZE = int(os.environ.get('PN_RENDER_CACHE_SIZE', 256))
+
+#  Seconds the email plugins (ses, smtp) collect the notifications about a task group going to the same recipients,
+#  to send them as a single digest. Digests are disabled when 0 (the default).
+DIGEST_WINDOW = float(os.environ.get('PN_EMAIL_DIGEST_WINDOW', 0))
+
+#  Maximum number of notifications in one digest. A digest is sent as soon as it is full.
+DIGEST_MAX_SIZE = int(os.environ.get('PN_EMAIL_DIGEST_MAX_SIZE', 100))
+
+
+class EmailRenderer(object):
+    """
+    Renders the bodies of the emails sent by the ses and smtp plugins.
+
+    Templates are compiled once, and the MIME part of a body is built once for identical inputs: the same task
+    notified to several identities, or by both email plugins, renders and encodes its body a single time. The last
+    cache_size parts are kept. MIME parts are not modified when sent, so they are shared between emails.
+    """
+    def __init__(self, cache_size=RENDER_CACHE_SIZE, bytecode_cache_dir=TEMPLATE_CACHE_DIR):
+        bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir) if bytecode_cache_dir else None
+        self.env = Environment(loader=PackageLoader('pulsenotify', 'templates'), bytecode_cache=bytecode_cache,
+                               auto_reload=False)
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._templates = {}
+        self._parts = OrderedDict()
+
+    def get_template(self, name):
+        if name not in self._templates:
+            try:
+                self._templates[name] = self.env.get_template(name)
+                log.debug('%s loaded', name)
+            except TemplateNotFound:
+                log.exception('Couldn\'t find %s. Defaulting to text email message.', name)
+                self._templates[name] = None
+        return self._templates[name]
+
+    def _part(self, key, render):
+        part = self._parts.get(key)
+        if part is not None:
+            self._parts.move_to_end(key)
+            self.hits += 1
+            return part
+
+        self.misses += 1
+        part = self._parts[key] = render()
+        while len(self._parts) > self.cache_size:
+            self._parts.popitem(last=False)
+        return part
+
+    def task_part(self, subject, message, inspector_url, logs):
+        #  Body of the email about a single task. logs are the urls of the task's logs.
+        template = self.get_template(EMAIL_TEMPLATE)
+        if template is None:
+            return self._part(('text', message), lambda: MIMEText(message, 'text'))
+
+        date = today()
+        logs = tuple(logs)
+        return self._part((EMAIL_TEMPLATE, date, subject, message, inspector_url, logs),
+                          lambda: MIMEText(template.render(subject=subject, body=message, date=date, logs=logs,
+                                                           inspector_url=inspector_url), 'html'))
+
+    def digest_part(self, subject, entries):
+        #  Body of the digest of entries, a list of (task_data, config)
+        template = self.get_template(EMAIL_TEMPLATE)
+        if template is None:
+            text = '\n\n'.join(config['message'] for _, config in entries)
+            return self._part(('text', text), lambda: MIMEText(text, 'text'))
+
+        date = today()
+        tasks = tuple((config['message'], task_data.inspector_url, log_urls(task_data))
+                      for task_data, config in entries)
+        return self._part((EMAIL_TEMPLATE, date, subject, tasks),
+                          lambda: MIMEText(template.render(subject=subject, date=date, tasks=[{
+                              'body': body,
+                              'inspector_url': inspector_url,
+                              'logs': logs,
+                          } for body, inspector_url, logs in tasks]), 'html'))
+
+
+def today():
+    return datetime.datetime.now().strftime('%b %d, %Y')
+
+
+def log_urls(task_data):
+    return tuple(run_log['destination_url'] for run_log in task_data.log_data())
+
+
+def build_email(subject, recipients, part, headers=()):
+    #  Returns the email to send, as a string
+    email_message = MIMEMultipart()
+    email_message['Subject'] = subject
+    email_message['To'] = ', '.join(recipients)
+    email_message.attach(part)
+    for name, value in headers:
+        email_message.add_header(name, value)
+    return email_message.as_string()
+
+
+renderer = EmailRenderer()
+
+
+def digest_key(task_data, config):
+    #  Notifications are batched by task group and recipients, whatever the order the recipients are listed in
+    return task_data.task_group_id, tuple(sorted(config['emails']))
+
+
+def digest_subject(entries):
+    task_data, config = entries[0]
+    subjects = {config['subject'] for _, config in entries}
+    if len(subjects) == 1:
+        return '{} ({} tasks)'.format(config['subject'], len(entries))
+    return '{} notifications for task group {}'.format(len(entries), task_data.task_group_id)
+
+
+class DigestBatcher(object):
+    """
+    Batches the notifications of an email plugin into digests.
+
+    The first notification for a key opens a window of window seconds, during which every other notification with the
+    same key joins the digest. When the window closes, or as soon as the digest holds max_size notifications, the
+    digest is sent with send(entries). add returns a future done once the digest is sent, which raises what send raised
+    so each notification of a failed digest is spooled on its own. Notifications don't hold a worker of the plugin
+    while they wait for their digest.
+    """
+    def __init__(self, send, window=DIGEST_WINDOW, max_size=DIGEST_MAX_SIZE):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self._digests = {}
+        self._sending = set()
+
+    def __len__(self):
+        return len(self._digests)
+
+    def add(self, key, entry):
+        digest = self._digests.get(key)
+        if digest is None:
+            loop = asyncio.get_event_loop()
+            digest = self._digests[key] = {
+                'entries': [],
+                'sent': asyncio.Future(),
+                'timer': loop.call_later(self.window, self.flush, key),
+            }
+
+        digest['entries'].append(entry)
+        sent = digest['sent']
+        if len(digest['entries']) >= self.max_size:
+            self.flush(key)
+        #  The future is shared by every notification of the digest and must not be cancelled with one of them
+        return asyncio.shield(sent)
+
+    def flush(self, key):
+        digest = self._digests.pop(key, None)
+        if digest is None:
+            return
+        digest['timer'].cancel()
+        sending = asyncio.ensure_future(self._send(digest['entries'], digest['sent']))
+        self._sending.add(sending)
+        sending.add_done_callback(self._sending.discard)
+
+    async def _send(self, entries, sent):
+        log.debug('Sending digest of %s notifications', len(entries))
+        try:
+            await self.send(entries)
+        except Exception as e:
+            sent.set_exception(e)
+        else:
+            sent.set_result(None)
+
+    async def close(self):
+        #  Sends the digests still open without waiting for their window to close
+        for key in list(self._digests):
+            self.flush(key)
+        if self._sending:
+            await asyncio.wait(list(self._sending))
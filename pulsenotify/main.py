@@ -1,25 +1,75 @@
+import asyncio
 import logging
 import os
+import signal
 from pulsenotify.consumer import NotifyConsumer
 from pulsenotify import event_loop
+from pulsenotify.metrics import MetricsServer, SnapshotWriter, METRICS_PORT
+from pulsenotify.supervisor import Supervisor, WORKERS
 from pulsenotify.worker import worker
 
 
 log = logging.getLogger(__name__)
 
 
-def cli():
+def run(loop, worker_id=None, snapshot_path=None):
+    #  Runs a worker on loop until it is interrupted (SIGINT) or terminated (SIGTERM), then shuts it down: stop
+    #  consuming, finish the messages already received and close every connection.
+    consumer = NotifyConsumer(worker_id)
+    if snapshot_path is not None:
+        metrics_service = SnapshotWriter(snapshot_path)
+    elif METRICS_PORT:
+        metrics_service = MetricsServer(int(METRICS_PORT))
+    else:
+        metrics_service = None
+
+    async def start():
+        if metrics_service is not None:
+            await metrics_service.start()
+        await worker(consumer)
+
+    starting = asyncio.ensure_future(start(), loop=loop)
+
+    def terminate():
+        #  Stopping the loop under run_until_complete would raise, so a SIGTERM received while starting up cancels
+        #  the startup instead
+        if starting.done():
+            loop.stop()
+        else:
+            starting.cancel()
+
+    loop.add_signal_handler(signal.SIGTERM, terminate)
     try:
-        event_loop.run_until_complete(worker(NotifyConsumer()))
-        event_loop.run_forever()
+        consumer.start()
+        loop.run_until_complete(starting)
+        loop.run_forever()
+    except asyncio.CancelledError:
+        log.info('Terminated while starting up.')
     except KeyboardInterrupt:
-        # TODO: make better shutdown
         log.exception('KeyboardInterrupt registered, exiting.')
-        event_loop.stop()
-        while event_loop.is_running():
-            pass
-        event_loop.close()
-        exit()
+
+    log.info('Shutting down worker.')
+    loop.run_until_complete(consumer.shutdown())
+    if metrics_service is not None:
+        loop.run_until_complete(metrics_service.close())
+    loop.close()
+
+
+def run_worker_process(worker_id, snapshot_path):
+    #  Entry point of the processes forked by the supervisor, each running its own event loop. Plugins needing a name
+    #  of their own per worker read the worker number from PN_WORKER_ID.
+    os.environ['PN_WORKER_ID'] = str(worker_id)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    run(loop, worker_id, snapshot_path)
+
+
+def cli():
+    if WORKERS > 1:
+        Supervisor(WORKERS, run_worker_process, metrics_port=int(METRICS_PORT) if METRICS_PORT else None).run()
+    else:
+        run(event_loop)
+    exit()
 
 
 if __name__ == '__main__':
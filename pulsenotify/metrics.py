@@ -0,0 +1,426 @@
+import asyncio
+import influxdb
+import json
+import logging
+import os
+from bisect import bisect_left
+from collections import OrderedDict
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import monotonic
+
+log = logging.getLogger(__name__)
+
+#  InfluxDB settings. Points are buffered and written in batches of INFLUXDB_BATCH_SIZE, at least every
+#  INFLUXDB_FLUSH_INTERVAL seconds. Once INFLUXDB_MAX_BUFFER points are waiting, new points are dropped.
+INFLUXDB_RECORD = bool(int(os.environ.get('INFLUXDB_RECORD', 0)))
+INFLUXDB_HOST = os.environ.get('INFLUXDB_HOST', 'local')
+INFLUXDB_NAME = os.environ.get('INFLUXDB_NAME', 'time_notifications')
+INFLUXDB_BATCH_SIZE = int(os.environ.get('INFLUXDB_BATCH_SIZE', 100))
+INFLUXDB_FLUSH_INTERVAL = float(os.environ.get('INFLUXDB_FLUSH_INTERVAL', 10))
+INFLUXDB_MAX_BUFFER = int(os.environ.get('INFLUXDB_MAX_BUFFER', 10000))
+
+#  Upper bounds, in seconds, of the buckets latencies are counted in
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+#  Port and interface of the HTTP endpoint serving metrics in the Prometheus text format. Disabled unless a port is set.
+METRICS_PORT = os.environ.get('PN_METRICS_PORT')
+METRICS_HOST = os.environ.get('PN_METRICS_HOST', '0.0.0.0')
+EXPOSITION_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#  Seconds between the metrics snapshots written by each worker process in supervisor mode
+METRICS_SNAPSHOT_INTERVAL = float(os.environ.get('PN_METRICS_SNAPSHOT_INTERVAL', 5))
+
+
+class InfluxDBSink(object):
+    """
+    Buffers InfluxDB points in memory and writes them in batches.
+
+    Recording a point never blocks: writes happen from a background task, on a thread of their own so the
+    synchronous InfluxDB client doesn't stall the event loop, and points are dropped when the buffer is full.
+    """
+    def __init__(self, client, enabled=INFLUXDB_RECORD, batch_size=INFLUXDB_BATCH_SIZE,
+                 flush_interval=INFLUXDB_FLUSH_INTERVAL, max_buffer=INFLUXDB_MAX_BUFFER):
+        self.client = client
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.dropped = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._periodic_flush = None
+        self._flush = None
+
+    def record(self, point):
+        if not self.enabled:
+            return
+
+        if len(self.buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+
+        self.buffer.append(point)
+
+        if self._periodic_flush is None:
+            self._periodic_flush = asyncio.ensure_future(self.flush_periodically())
+        if len(self.buffer) >= self.batch_size and (self._flush is None or self._flush.done()):
+            self._flush = asyncio.ensure_future(self.flush())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        loop = asyncio.get_event_loop()
+        while self.buffer:
+            points, self.buffer = self.buffer[:self.batch_size], self.buffer[self.batch_size:]
+            try:
+                await loop.run_in_executor(self._executor, self.client.write_points, points)
+            except Exception as e:
+                log.exception('Could not write %s points to InfluxDB: %s', len(points), e)
+
+        if self.dropped:
+            log.warning('%s InfluxDB points dropped since last flush, buffer was full', self.dropped)
+            self.dropped = 0
+
+    async def close(self):
+        if self._periodic_flush is not None:
+            self._periodic_flush.cancel()
+            self._periodic_flush = None
+        if self._flush is not None:
+            await self._flush
+        await self.flush()
+        self._executor.shutdown(wait=True)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """
+    Value that only goes up, per combination of labels.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.series = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.series.items():
+            yield self.name, key, value
+
+
+class Gauge(object):
+    """
+    Value that goes up and down, either set directly or read from a function when collected.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.series = {}
+
+    def set(self, value, **labels):
+        self.series[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, (), self.function()
+        for key, value in self.series.items():
+            yield self.name, key, value
+
+
+class Histogram(object):
+    """
+    Distribution of observed values, counted in buckets per combination of labels.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            #  One count per bucket, plus one for values above the last bucket
+            series = self.series[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+
+        series['counts'][bisect_left(self.buckets, value)] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    def samples(self):
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series['counts']):
+                cumulative += count
+                yield self.name + '_bucket', key + (('le', _format_value(bound)),), cumulative
+            yield self.name + '_sum', key, series['sum']
+            yield self.name + '_count', key, series['count']
+
+
+class Registry(object):
+    """
+    Collection of the metrics exposed by the worker.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        #  The current value of every metric, as a JSON serializable list of
+        #  [name, kind, documentation, [[sample name, labels, value], ...]]
+        return [[metric.name, metric.kind, metric.documentation,
+                 [[name, [list(label) for label in labels], value] for name, labels, value in metric.samples()]]
+                for metric in self.metrics]
+
+    def exposition(self):
+        return render_exposition(self.snapshot())
+
+
+def render_exposition(snapshot):
+    #  Renders a registry snapshot in the Prometheus text exposition format
+    lines = []
+    for name, kind, documentation, samples in snapshot:
+        lines.append('# HELP {} {}'.format(name, documentation))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for sample_name, labels, value in samples:
+            lines.append('{}{} {}'.format(sample_name, _format_labels(tuple(tuple(label) for label in labels)),
+                                          _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def merge_snapshots(snapshots):
+    #  Combines the snapshots of several worker processes, given as {worker id: snapshot}. Counters and histograms
+    #  are added up, gauges are kept per worker with a 'worker' label.
+    families = OrderedDict()
+    for worker_id, snapshot in sorted(snapshots.items()):
+        for name, kind, documentation, samples in snapshot:
+            family = families.setdefault(name, (kind, documentation, OrderedDict()))
+            for sample_name, labels, value in samples:
+                labels = tuple(tuple(label) for label in labels)
+                if kind == 'gauge':
+                    labels = tuple(sorted(labels + (('worker', str(worker_id)),)))
+                key = (sample_name, labels)
+                family[2][key] = family[2].get(key, 0) + value
+    return [[name, kind, documentation, [[sample_name, labels, value]
+                                         for (sample_name, labels), value in samples.items()]]
+            for name, (kind, documentation, samples) in families.items()]
+
+
+class MessageTimings(object):
+    """
+    Times the stages of processing a single message.
+
+    Each stage is recorded in the stage latency histogram and sent to InfluxDB, tagged with the task status and
+    provisioner so the slow part of the pipeline can be found under load.
+    """
+    def __init__(self, **tags):
+        self.tags = tags
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, monotonic() - started)
+
+    def record(self, name, elapsed_time):
+        self.stages.append((name, elapsed_time))
+        stage_latency.observe(elapsed_time, stage=name, **self.tags)
+        influxdb_sink.record({
+            "measurement": "stage_timing",
+            "tags": dict(self.tags, host=INFLUXDB_HOST, stage=name),
+            "fields": {
+                "elapsed_time": elapsed_time,
+            },
+        })
+
+    def __str__(self):
+        return ', '.join('{}={:.4f}s'.format(name, elapsed_time) for name, elapsed_time in self.stages)
+
+
+influxdb_sink = InfluxDBSink(influxdb.InfluxDBClient(database=INFLUXDB_NAME))
+
+registry = Registry()
+
+stage_latency = registry.register(Histogram(
+    'pulsenotify_stage_seconds', 'Time spent in each stage of processing a Pulse message.'))
+messages_consumed = registry.register(Counter(
+    'pulsenotify_messages_consumed_total', 'Pulse messages received.'))
+messages_acked = registry.register(Counter(
+    'pulsenotify_messages_acked_total', 'Pulse messages acknowledged.'))
+messages_requeued = registry.register(Counter(
+    'pulsenotify_messages_requeued_total', 'Pulse messages put back in the queue while Taskcluster was unreachable.'))
+duplicate_messages = registry.register(Counter(
+    'pulsenotify_duplicate_messages_total', 'Pulse messages skipped, having already been processed.'))
+notifications = registry.register(Counter(
+    'pulsenotify_notifications_total', 'Plugin notifications, by plugin and result (sent or failed).'))
+retries = registry.register(Counter(
+    'pulsenotify_retries_total', 'Attempts retried by retry_connection, by retried function.'))
+in_flight_messages = registry.register(Gauge(
+    'pulsenotify_in_flight_messages', 'Pulse messages being processed.'))
+task_cache_hits = registry.register(Counter(
+    'pulsenotify_task_cache_hits_total', 'Task definitions served from the task cache.'))
+task_cache_misses = registry.register(Counter(
+    'pulsenotify_task_cache_misses_total', 'Task definitions fetched from Taskcluster.'))
+circuit_breaker_open = registry.register(Gauge(
+    'pulsenotify_circuit_breaker_open', 'Whether the circuit breaker of a remote endpoint is open (1) or closed (0).'))
+spooled_notifications = registry.register(Counter(
+    'pulsenotify_spooled_notifications_total',
+    'Failed notifications put in the retry spool, and later delivered or dropped, by plugin and result.'))
+spool_pending = registry.register(Gauge(
+    'pulsenotify_spool_pending', 'Notifications waiting in the retry spool.'))
+log_uploads = registry.register(Counter(
+    'pulsenotify_log_uploads_total', 'Run logs collected by log_collect, by result (uploaded, skipped or failed).'))
+plugin_queue_size = registry.register(Gauge(
+    'pulsenotify_plugin_queue_size', 'Notifications waiting to be sent, by plugin.'))
+consumption_paused = registry.register(Gauge(
+    'pulsenotify_consumption_paused', 'Whether consumption of Pulse messages is paused, a plugin queue being full.'))
+event_loop_lag = registry.register(Gauge(
+    'pulsenotify_event_loop_lag_seconds', 'How late the event loop last ran a scheduled callback.'))
+
+
+async def monitor_event_loop_lag(interval=1.0):
+    #  A busy or blocked event loop wakes this coroutine up later than it asked for
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        event_loop_lag.set(max(0.0, loop.time() - expected))
+
+
+class MetricsServer(object):
+    """
+    HTTP endpoint serving the metrics registry in the Prometheus text format at /metrics.
+
+    The server runs on the worker's event loop, next to the AMQP consumer.
+    """
+    def __init__(self, port, host=METRICS_HOST, registry=registry):
+        self.port = port
+        self.host = host
+        self.registry = registry
+        self.app = None
+        self.handler = None
+        self.server = None
+        self._lag_monitor = None
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self.app = web.Application(loop=loop)
+        self.app.router.add_route('GET', '/metrics', self.handle_metrics)
+        self.handler = self.app.make_handler()
+        self.server = await loop.create_server(self.handler, self.host, self.port)
+        self._lag_monitor = asyncio.ensure_future(monitor_event_loop_lag())
+        log.info('Serving metrics on %s:%s', self.host, self.port)
+
+    async def handle_metrics(self, request):
+        return web.Response(body=self.registry.exposition().encode('utf-8'),
+                            headers={'Content-Type': EXPOSITION_CONTENT_TYPE})
+
+    async def close(self):
+        self._lag_monitor.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        await self.app.shutdown()
+        await self.handler.shutdown(5)
+        await self.app.cleanup()
+
+
+class SnapshotWriter(object):
+    """
+    Writes a snapshot of the metrics registry to a file every interval seconds, for the supervisor to aggregate the
+    metrics of its worker processes. The file is replaced atomically, so it is never read half written.
+    """
+    def __init__(self, path, interval=METRICS_SNAPSHOT_INTERVAL, registry=registry):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._writing = None
+        self._lag_monitor = None
+
+    def write(self):
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(temporary_path, self.path)
+
+    async def write_periodically(self):
+        while True:
+            try:
+                self.write()
+            except OSError as e:
+                log.exception('Could not write metrics snapshot to %s: %s', self.path, e)
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        self._writing = asyncio.ensure_future(self.write_periodically())
+        self._lag_monitor = asyncio.ensure_future(monitor_event_loop_lag())
+
+    async def close(self):
+        for task in (self._writing, self._lag_monitor):
+            if task is not None:
+                task.cancel()
+        self.write()
+
+
+def read_snapshots(directory):
+    #  Reads the snapshots written by the SnapshotWriter of each worker, named <worker id>.json
+    snapshots = {}
+    for filename in os.listdir(directory):
+        worker_id, extension = os.path.splitext(filename)
+        if extension != '.json':
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                snapshots[worker_id] = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning('Could not read metrics snapshot %s: %s', filename, e)
+    return snapshots
+
+
+def record_timing(service, elapsed_time):
+    influxdb_sink.record({
+        "measurement": "notify_timing",
+        "tags": {
+            "host": INFLUXDB_HOST,
+            "service": service,
+        },
+        "fields": {
+            "elapsed_time": str(elapsed_time),
+        },
+    })
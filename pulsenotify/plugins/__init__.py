@@ -1,13 +1,34 @@
+import boto3
 import logging
 import os
 
-from pulsenotify.util import async_time_me
+from botocore.config import Config
+from pulsenotify.util import async_time_me, circuit_breaker, endpoint_of, run_blocking
 
 log = logging.getLogger(__name__)
 
+#  How much of a task's logs a plugin uses. Logs are only looked up when an enabled plugin needs them.
+LOGS_NONE = 0  # the plugin doesn't use logs
+LOGS_URLS = 1  # the plugin only links to the logs uploaded to S3
+LOGS_BODIES = 2  # the plugin reads the contents of the logs
+
+#  Size of the connection pool of each AWS client, shared by the executor threads using the client
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 10))
+
+#  Default number of workers sending the notifications of a plugin, shared by all messages
+PLUGIN_CONCURRENCY = int(os.environ.get('PN_PLUGIN_CONCURRENCY', 10))
+
+
+class NotificationFailedError(Exception):
+    """ Exception raised by a plugin that gave up on delivering a notification """
+    pass
+
 
 class BasePlugin(object):
 
+    logs_required = LOGS_NONE
+    max_concurrency = PLUGIN_CONCURRENCY
+
     def __init__(self):
         log.info('%s plugin initialized', self.name)
 
@@ -15,14 +36,36 @@ class BasePlugin(object):
     def name(self):
         return self.__module__.split('.')[-1]
 
+    #  Plugins batching notifications return a future done once the notification is sent, rather than wait for it
     @async_time_me
     async def notify(self, task_data, exchange_config):
         log.error('Notify not implemented for %s', self.name)
         return None
 
+    async def close(self):
+        #  Called once on shutdown, for plugins holding on to connections or pending work
+        pass
+
 
 class AWSPlugin(BasePlugin):
     def __init__(self):
         self.access_key_id = os.environ['AWS_ACCESS_KEY_ID']
         self.secret_access_key = os.environ['AWS_SECRET_ACCESS_KEY']
         log.info('%s plugin initialized', self.name)
+
+    def create_client(self, service_name, region_name=None):
+        #  Building a boto3 client is expensive (loading the service model, resolving credentials, opening a new
+        #  connection pool), but clients are thread-safe. Plugins create one at init and reuse it for every
+        #  notification, from any executor thread.
+        session = boto3.session.Session(aws_access_key_id=self.access_key_id,
+                                        aws_secret_access_key=self.secret_access_key,
+                                        region_name=region_name)
+        client = session.client(service_name, config=Config(max_pool_connections=AWS_MAX_POOL_CONNECTIONS))
+        #  Every call made with the client goes through the circuit breaker of its endpoint, see call_client
+        self.breaker = circuit_breaker(endpoint_of(client.meta.endpoint_url))
+        return client
+
+    async def call_client(self, method_name, **kwargs):
+        #  Calls to AWS are blocking and run on the executor. They fail fast while the endpoint's circuit is open.
+        with self.breaker:
+            return await run_blocking(getattr(self.client, method_name), **kwargs)
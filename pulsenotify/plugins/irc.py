@@ -1,7 +1,9 @@
 import asyncio
 import os
 import logging
-from . import BasePlugin
+from collections import deque, OrderedDict
+from time import monotonic
+from . import BasePlugin, LOGS_URLS, NotificationFailedError
 
 from bottom import Client
 
@@ -24,7 +26,29 @@ COLOUR_MAP = {
     'task-exception': 'PURPLE',
 }
 
-NOTIFY_SIGNAL_NAME = 'SEND_NOTIFY'
+#  Outgoing lines are paced to IRC_LINES_PER_SECOND, allowing bursts of up to IRC_BURST lines, to stay under the
+#  server's flood limits
+IRC_LINES_PER_SECOND = float(os.environ.get('IRC_LINES_PER_SECOND', 1))
+IRC_BURST = int(os.environ.get('IRC_BURST', 5))
+
+#  Lines waiting for the same channel are joined into lines of up to this many bytes
+IRC_MAX_LINE_LENGTH = int(os.environ.get('IRC_MAX_LINE_LENGTH', 400))
+
+#  Maximum number of lines waiting to be sent. Notifications are spooled beyond that.
+IRC_MAX_PENDING_LINES = int(os.environ.get('IRC_MAX_PENDING_LINES', 1000))
+
+#  Separator between the lines joined together
+COALESCE_SEPARATOR = ' | '
+
+#  Seconds to wait for the client to be registered with the server before connecting again
+RECONNECT_INTERVAL = 10
+
+#  Seconds to wait for the server to confirm a JOIN. bottom doesn't parse the numerics a server refuses a JOIN with,
+#  so a JOIN that isn't confirmed in time is taken as refused.
+JOIN_TIMEOUT = 10
+
+#  Seconds given to the pending lines to be sent on shutdown
+CLOSE_TIMEOUT = 5
 
 
 def irc_format(string, fmt_type):
@@ -32,6 +56,191 @@ def irc_format(string, fmt_type):
     return '{0}{1}{0}'.format(IRC_CODES.get(fmt_type, ''), string)
 
 
+def worker_nick(nick, worker_id=None):
+    #  Each worker process of a supervisor has its own connection, and a server only lets one of them use a nick
+    if worker_id is None:
+        return nick
+    return '{}-{}'.format(nick, worker_id)
+
+
+class TokenBucket(object):
+    """
+    Allows rate operations per second on average, with bursts of up to capacity operations.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def take(self):
+        self.refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.refill()
+        self.tokens -= 1
+
+
+class IRCSendQueue(object):
+    """
+    Outgoing queue of the lines to send to IRC channels.
+
+    Lines are sent by a single background task, paced by a token bucket so bursts of notifications don't get the bot
+    kicked for flooding. Nothing is sent until the client is registered with the server (see registered), and a
+    channel's lines are only sent once the server has confirmed the bot joined it (see confirm_join). Channels are
+    joined once per connection. Lines waiting for the same channel are joined together into longer lines, and channels
+    take turns so a busy channel doesn't delay the others.
+    """
+    def __init__(self, client, rate=IRC_LINES_PER_SECOND, burst=IRC_BURST, max_line_length=IRC_MAX_LINE_LENGTH,
+                 max_pending_lines=IRC_MAX_PENDING_LINES):
+        self.client = client
+        self.bucket = TokenBucket(rate, burst)
+        self.max_line_length = max_line_length
+        self.max_pending_lines = max_pending_lines
+        self.registered = asyncio.Event()
+        self.joined = set()
+        self.joining = {}
+        self.pending = OrderedDict()
+        self.pending_lines = 0
+        self._reconnected_at = None
+        self._wakeup = None
+        self._sender = None
+
+    def put(self, channels, lines):
+        #  Queues lines for each of channels, or none of them when the queue is full so the notification can be
+        #  retried as a whole
+        if self.pending_lines + len(lines) * len(channels) > self.max_pending_lines:
+            raise NotificationFailedError('IRC send queue is full, could not queue {} lines for {}'.format(
+                len(lines), ', '.join(channels)))
+
+        for channel in channels:
+            self.pending.setdefault(channel, deque()).extend(lines)
+            self.pending_lines += len(lines)
+        if self._sender is None:
+            self._wakeup = asyncio.Event()
+            self._sender = asyncio.ensure_future(self.send_pending())
+        self._wakeup.set()
+
+    def take_line(self, channel):
+        #  Joins as many of the channel's waiting lines as fit in one line, and moves the channel to the back
+        lines = self.pending.pop(channel)
+        parts = [lines.popleft()]
+        while lines and self.fits(parts + [lines[0]]):
+            parts.append(lines.popleft())
+        if lines:
+            self.pending[channel] = lines
+        self.pending_lines -= len(parts)
+        if len(parts) == 1:
+            return parts[0]
+        return COALESCE_SEPARATOR.join(part.strip() for part in parts)
+
+    def fits(self, parts):
+        return len(COALESCE_SEPARATOR.join(part.strip() for part in parts).encode('utf-8')) <= self.max_line_length
+
+    def requeue(self, channel, line):
+        self.pending.setdefault(channel, deque()).appendleft(line)
+        self.pending.move_to_end(channel, last=False)
+        self.pending_lines += 1
+
+    def drop(self, channel):
+        lines = self.pending.pop(channel, ())
+        self.pending_lines -= len(lines)
+        log.warning('Could not join %s, dropping %s lines', channel, len(lines))
+
+    async def send_pending(self):
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if not self.registered.is_set():
+                await self.wait_registered()
+                continue
+
+            channel = next(iter(self.pending))
+            if channel not in self.joined and not await self.join(channel):
+                #  Lines for a channel the server refused to let the bot join can't be sent. They are kept when the
+                #  connection dropped instead, and sent once the client is registered again.
+                if self.registered.is_set():
+                    self.drop(channel)
+                continue
+
+            line = self.take_line(channel)
+            try:
+                await self.bucket.take()
+                self.client.send('PRIVMSG', target=channel, message=line)
+            except RuntimeError:
+                #  RuntimeError is raised when the client isn't connected. The line is kept, and sent once the
+                #  client is connected again.
+                self.requeue(channel, line)
+                self.disconnected()
+                self.reconnect()
+
+    async def wait_registered(self):
+        try:
+            await asyncio.wait_for(self.registered.wait(), RECONNECT_INTERVAL)
+        except asyncio.TimeoutError:
+            self.reconnect()
+
+    async def join(self, channel):
+        #  Returns whether the server confirmed the bot joined channel
+        joining = self.joining[channel.lower()] = asyncio.Future()
+        try:
+            await self.bucket.take()
+            self.client.send('JOIN', channel=channel)
+            await asyncio.wait_for(asyncio.shield(joining), JOIN_TIMEOUT)
+        except RuntimeError:
+            self.disconnected()
+            self.reconnect()
+            return False
+        except asyncio.TimeoutError:
+            log.warning('The IRC server did not confirm joining %s', channel)
+            return False
+        finally:
+            self.joining.pop(channel.lower(), None)
+
+        if joining.result():
+            self.joined.add(channel)
+        return joining.result()
+
+    def confirm_join(self, channel):
+        #  Called when the server echoes the bot's JOIN. Channel names are case insensitive.
+        joining = self.joining.get(channel.lower())
+        if joining is not None and not joining.done():
+            joining.set_result(True)
+
+    def disconnected(self):
+        #  Channels have to be joined again once registered on a new connection
+        self.registered.clear()
+        self.joined.clear()
+        for joining in self.joining.values():
+            if not joining.done():
+                joining.set_result(False)
+
+    def reconnect(self):
+        #  The client reconnects by itself when the connection drops, but not if the first connection failed
+        if self._reconnected_at is None or monotonic() - self._reconnected_at > RECONNECT_INTERVAL:
+            self._reconnected_at = monotonic()
+            self.client.trigger('CLIENT_DISCONNECT')
+
+    async def close(self, timeout=CLOSE_TIMEOUT):
+        if self._sender is None:
+            return
+        deadline = monotonic() + timeout
+        while self.pending and monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending_lines:
+            log.warning('Dropping %s IRC lines that were not sent', self.pending_lines)
+        self._sender.cancel()
+        self._sender = None
+
+
 class Plugin(BasePlugin):
     """
     Internet Relay Chat Plugin for the Pulse Notification system
@@ -42,18 +251,26 @@ class Plugin(BasePlugin):
         - IRC_NICK
         - IRC_PORT
         - IRC_PASS
+
+    Worker processes of a supervisor connect with IRC_NICK suffixed with their worker number.
     """
 
+    logs_required = LOGS_URLS
+
     def __init__(self, loop=None):
         #  Create the client and add all functions with 'on' decorator as event handlers for
         #  different irc message types
         self.irc_client = Client(host=os.environ['IRC_HOST'],
                                  port=os.environ['IRC_PORT'],
                                  ssl=True, loop=loop)
+        self.send_queue = IRCSendQueue(self.irc_client)
+        self.nick = worker_nick(os.environ['IRC_NICK'], os.environ.get('PN_WORKER_ID'))
 
         @self.irc_client.on('CLIENT_CONNECT')
         def connect(**kwargs):
-            self.irc_client.send('NICK', nick=os.environ['IRC_NICK'])
+            #  Nothing is sent on a new connection until the server has accepted the registration
+            self.send_queue.disconnected()
+            self.irc_client.send('NICK', nick=self.nick)
             self.irc_client.send('USER', user=os.environ['IRC_NAME'], realname=os.environ['IRC_NAME'])
             self.irc_client.send('PASS', password=os.environ['IRC_PASS'])
 
@@ -61,30 +278,26 @@ class Plugin(BasePlugin):
         async def reconnect(**kwargs):
             #  If the client disconnects, try and reconnect
             log.debug('Disconnect registered, reconnecting...')
+            self.send_queue.disconnected()
             try:
                 await self.irc_client.connect()
             except ConnectionRefusedError:
                 log.exception('IRC reconnection refused.')
 
+        @self.irc_client.on('RPL_WELCOME')
+        def registered(**kwargs):
+            self.send_queue.registered.set()
+
+        @self.irc_client.on('JOIN')
+        def joined(nick, channel, **kwargs):
+            if nick.lower() == self.nick.lower():
+                self.send_queue.confirm_join(channel)
+
         @self.irc_client.on('PING')
         def keep_alive(message, **kwargs):
             #  Reply to a 'ping' message with a 'pong'
             self.irc_client.send('PONG', message=message)
 
-        @self.irc_client.on(NOTIFY_SIGNAL_NAME)
-        async def irc_notify(task_id=None, status=None, logs=None, channel=None, message=None, **kwargs):
-            #  Send a notification message to a channel
-            self.irc_client.send('JOIN', channel=channel)
-            task_message = '{task_id}: {message}'.format(task_id=task_id, message=message)
-            self.irc_client.send('privmsg', target=channel, message=irc_format(task_message, status))
-
-            #  Send the log links, tabbed out
-            if logs is not None:
-                for log_link in logs:
-                    self.irc_client.send('privmsg',
-                                         target=channel,
-                                         message=irc_format('\t\t' + log_link['destination_url'], status))
-
         self.irc_client.loop.create_task(self.irc_client.connect())
 
         log.info('{} plugin initialized.'.format(self.name))
@@ -94,21 +307,14 @@ class Plugin(BasePlugin):
             log.debug('No IRC channels specified in task %r notification config.', task_data)
             return
 
-        for chan in status_config['channels']:
-            try:
-                self._send_message(task_data, status_config, chan)
-            except RuntimeError as e:
-                # RuntimeError can occur when client isn't connected
-                await self.irc_client.trigger('CLIENT_DISCONNECT')
-                # Slow down pulsenotify in case the IRC client is bit slow
-                await asyncio.sleep(0.1)
-                self._send_message(task_data, status_config, chan)
-            except TypeError as te:
-                log.exception('TypeError: %s', te)
+        #  The notification and its log links, tabbed out, are queued and sent in the background
+        task_message = '{task_id}: {message}'.format(task_id=task_data.id, message=status_config['message'])
+        lines = [irc_format(task_message, task_data.status)]
+        lines.extend('\t\t' + irc_format(log_link['destination_url'], task_data.status)
+                     for log_link in task_data.log_data())
+        self.send_queue.put(status_config['channels'], lines)
 
         log.info('Notified with IRC for %s', task_data)
 
-    def _send_message(self, task_data, status_config, channel):
-        self.irc_client.trigger(NOTIFY_SIGNAL_NAME, status=task_data.status, channel=channel,
-                                message=status_config['message'], logs=task_data.log_data(),
-                                task_id=task_data.id)
+    async def close(self):
+        await self.send_queue.close()
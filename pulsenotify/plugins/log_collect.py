@@ -1,9 +1,18 @@
+import asyncio
 import logging
-import gzip
 import os
-import boto3
-from . import AWSPlugin
-from pulsenotify.util import async_time_me
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import time
+
+from botocore.exceptions import ClientError
+
+from . import AWSPlugin, LOGS_BODIES, NotificationFailedError
+from pulsenotify import metrics
+from pulsenotify.util import async_time_me, failed_permanently, retry_connection, run_blocking, CircuitOpenError
+from pulsenotify.util import RetriesExceededError
 
 log = logging.getLogger(__name__)
 
@@ -14,12 +23,90 @@ HEADER = {
     'ContentEncoding': 'gzip',
 }
 
+#  Size of the chunks read from the log response before being compressed
+CHUNK_SIZE = int(os.environ.get('LOG_COLLECT_CHUNK_SIZE', 64 * 1024))
+
+#  Compressed data is uploaded in parts of this size. S3 requires every part of a multipart upload except the last
+#  one to be at least 5MB, so this also bounds the amount of log kept in memory during an upload.
+PART_SIZE = max(int(os.environ.get('LOG_COLLECT_PART_SIZE', 5 * 1024 * 1024)), 5 * 1024 * 1024)
+
+#  Maximum number of run logs of a single task uploaded at the same time
+CONCURRENCY = int(os.environ.get('LOG_COLLECT_CONCURRENCY', 4))
+
+#  zlib window bits value producing a gzip container, as gzip.compress does
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+#  SQLite database of the logs already uploaded, so a log is uploaded once however many messages are about its run.
+#  Entries are forgotten after LOG_COLLECT_MANIFEST_TTL seconds (default 30 days).
+MANIFEST_PATH = os.environ.get('LOG_COLLECT_MANIFEST_PATH', 'pulsenotify-uploads.sqlite3')
+MANIFEST_TTL = float(os.environ.get('LOG_COLLECT_MANIFEST_TTL', 30 * 24 * 3600))
+
+MANIFEST_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS uploads (
+    s3_key TEXT PRIMARY KEY,
+    uploaded_at REAL NOT NULL
+)
+'''
+
+
+class UploadManifest(object):
+    """
+    Index of the logs uploaded to S3, kept in a SQLite database.
+
+    The database can be shared by the worker processes of a supervisor. Database calls are blocking and run on a
+    thread of their own.
+    """
+    def __init__(self, path=MANIFEST_PATH, ttl=MANIFEST_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args))
+
+    def _connect(self):
+        #  Expired entries are removed when the database is first used
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=10)
+            self._connection.execute(MANIFEST_SCHEMA)
+            self._connection.execute('DELETE FROM uploads WHERE uploaded_at < ?', (time() - self.ttl,))
+        return self._connection
+
+    def _contains(self, s3_key):
+        return self._connect().execute('SELECT 1 FROM uploads WHERE s3_key = ?', (s3_key,)).fetchone() is not None
+
+    def _add(self, s3_key):
+        self._connect().execute('INSERT OR REPLACE INTO uploads (s3_key, uploaded_at) VALUES (?, ?)', (s3_key, time()))
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    async def contains(self, s3_key):
+        return await self._run(self._contains, s3_key)
+
+    async def add(self, s3_key):
+        await self._run(self._add, s3_key)
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
 
 class Plugin(AWSPlugin):
 
+    logs_required = LOGS_BODIES
+
     def __init__(self):
         super(Plugin, self).__init__()
         self.s3_bucket = os.environ['S3_BUCKET']
+        self.client = self.create_client('s3')
+        self.manifest = UploadManifest()
+        #  Uploads in progress by S3 key, shared by the messages about the same run
+        self._uploading = {}
 
     @async_time_me
     async def notify(self, task_data, exchange_config):
@@ -29,24 +116,137 @@ class Plugin(AWSPlugin):
             log.debug('No logs for %r', task_data)
             return
 
-        s3 = boto3.resource('s3', aws_access_key_id=self.access_key_id, aws_secret_access_key=self.secret_access_key)
-        log_bucket = s3.Bucket(self.s3_bucket)
+        #  Runs are uploaded concurrently, so a slow run doesn't hold up the others
+        limit = asyncio.Semaphore(CONCURRENCY)
+        results = await asyncio.gather(*[self.collect_run_log(task_data, run_log, limit) for run_log in log_data],
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            if isinstance(error, CircuitOpenError):
+                raise error
+        if errors:
+            #  The notification is only dropped rather than retried when every log failed permanently
+            cause = next((error for error in errors if not failed_permanently(error)), errors[0])
+            raise NotificationFailedError('{}: could not upload {} of the logs for {!r}'.format(
+                self.name, len(errors), task_data)) from cause
+
+    async def collect_run_log(self, task_data, run_log, limit):
+        async with limit:
+            #  The same run can be collected for several messages at the same time, only one of them uploads it
+            s3_key = run_log['s3_key']
+            uploading = self._uploading.get(s3_key)
+            if uploading is None:
+                uploading = self._uploading[s3_key] = asyncio.ensure_future(self.collect_once(task_data, run_log))
+                uploading.add_done_callback(lambda _: self._uploading.pop(s3_key, None))
+            return await asyncio.shield(uploading)
+
+    async def collect_once(self, task_data, run_log):
+        #  A log that can't be checked isn't uploaded, and is collected again when the notification is retried. Errors
+        #  are raised for notify to tell the permanent failures apart.
+        try:
+            if await self.already_uploaded(run_log['s3_key']):
+                log.debug('%s: log for %r run %s already uploaded', self.name, task_data, run_log['run_id'])
+                metrics.log_uploads.inc(result='skipped')
+                return True
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            log.warning('%s: could not check whether the log for %r run %s was uploaded: %s',
+                        self.name, task_data, run_log['run_id'], e)
+            metrics.log_uploads.inc(result='failed')
+            raise
+
+        #  A failure part way through the stream restarts the upload of this run's log from the beginning
+        try:
+            with task_data.timings.stage('upload_log'):
+                await retry_connection(self.upload_log, task_data, run_log)
+        except RetriesExceededError:
+            log.exception('%s: could not upload log for %r run %s', self.name, task_data, run_log['run_id'])
+            metrics.log_uploads.inc(result='failed')
+            raise
+
+        metrics.log_uploads.inc(result='uploaded')
+        await self.record_upload(run_log['s3_key'])
+        log.info('%s: log for %r uploaded to Amazon S3', self.name, task_data)
+        return True
+
+    async def already_uploaded(self, s3_key):
+        #  Logs uploaded by this or another worker are in the manifest. Others, ie uploaded before the manifest was
+        #  lost, are found with a HEAD request, which is much cheaper than downloading and compressing the log again.
+        #  Only a 404 means the log has to be uploaded, other errors are raised.
+        try:
+            if await self.manifest.contains(s3_key):
+                return True
+        except sqlite3.Error as e:
+            log.warning('%s: could not read the upload manifest: %s', self.name, e)
+
+        try:
+            await self.call_client('head_object', Bucket=self.s3_bucket, Key=s3_key)
+        except ClientError as e:
+            if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 404:
+                return False
+            raise
+
+        await self.record_upload(s3_key)
+        return True
+
+    async def record_upload(self, s3_key):
+        #  The log is in S3 whether or not it could be recorded, so failing to record it is only logged
+        try:
+            await self.manifest.add(s3_key)
+        except sqlite3.Error as e:
+            log.warning('%s: could not record %s in the upload manifest: %s', self.name, s3_key, e)
+
+    async def upload_log(self, task_data, run_log):
+        #  Stream the log from Taskcluster, gzip it chunk by chunk and upload the compressed data to S3 in parts,
+        #  so memory use doesn't grow with the size of the log. Most logs compress to less than a part, and are
+        #  uploaded with a single request instead. The multipart upload is only created once a full part is ready.
+        s3_key = run_log['s3_key']
+        compressor = zlib.compressobj(9, zlib.DEFLATED, GZIP_WBITS)
+        upload_id = None
+        parts = []
+        pending = bytearray()
+
+        try:
+            async with task_data.open_log(run_log['source_url']) as response:
+                response.raise_for_status()
+                while True:
+                    chunk = await response.content.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+
+                    pending.extend(compressor.compress(chunk))
+                    if len(pending) >= PART_SIZE:
+                        if upload_id is None:
+                            upload = await self.call_client('create_multipart_upload',
+                                                            Bucket=self.s3_bucket, Key=s3_key, **HEADER)
+                            upload_id = upload['UploadId']
+                        parts.append(await self.upload_part(s3_key, upload_id, len(parts) + 1, pending))
+                        pending = bytearray()
+
+            pending.extend(compressor.flush())
+            if upload_id is None:
+                await self.call_client('put_object', Bucket=self.s3_bucket, Key=s3_key, Body=bytes(pending), **HEADER)
+                log.debug('Uploaded %s in a single request', s3_key)
+                return True
+
+            parts.append(await self.upload_part(s3_key, upload_id, len(parts) + 1, pending))
+            await self.call_client('complete_multipart_upload', Bucket=self.s3_bucket, Key=s3_key,
+                                   UploadId=upload_id, MultipartUpload={'Parts': parts})
 
-        for run_log in log_data:
-            #  Use gzip compression on log
-            log.debug('Compressing artifact.')
-            try:
-                if type(run_log['data']) is str:
-                    log.debug('Artifact with key %s is str, converting', run_log['s3_key'])
-                    task_log = bytes(run_log['data'], 'utf-8')
-                else:
-                    task_log = run_log['data']
+        except Exception:
+            if upload_id is not None:
+                await run_blocking(self.client.abort_multipart_upload, Bucket=self.s3_bucket, Key=s3_key,
+                                   UploadId=upload_id)
+            raise
 
-                log_gzip = gzip.compress(task_log)
-            except TypeError as te:
-                log.exception('TypeError: %s', te)
+        log.debug('Uploaded %s in %s parts', s3_key, len(parts))
+        return True
 
-            #  Upload log to S3 bucket
-            log_bucket.put_object(Body=log_gzip, Key=run_log['s3_key'], **HEADER)
+    async def close(self):
+        await self.manifest.close()
 
-            log.info('%s: log for %r uploaded to Amazon S3', self.name, task_data)
+    async def upload_part(self, s3_key, upload_id, part_number, data):
+        response = await self.call_client('upload_part', Bucket=self.s3_bucket, Key=s3_key, UploadId=upload_id,
+                                          PartNumber=part_number, Body=bytes(data))
+        return {'ETag': response['ETag'], 'PartNumber': part_number}
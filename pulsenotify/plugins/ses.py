@@ -1,75 +1,82 @@
-import boto3
-from boto3.exceptions import Boto3Error
 import logging
 import os
-import datetime
 
-from . import AWSPlugin
-from pulsenotify.util import async_time_me
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from jinja2 import PackageLoader, Environment, TemplateNotFound
+from . import AWSPlugin, LOGS_URLS, NotificationFailedError
+from pulsenotify.mail import build_email, digest_key, digest_subject, log_urls, renderer, DigestBatcher
+from pulsenotify.mail import DIGEST_WINDOW, EMAIL_TEMPLATE
+from pulsenotify.util import async_time_me, retry_connection, RetriesExceededError
 
 log = logging.getLogger(__name__)
 
-env = Environment(loader=PackageLoader('pulsenotify', 'templates'))
-
 
 class Plugin(AWSPlugin):
 
+    logs_required = LOGS_URLS
+
     def __init__(self):
         super().__init__()
         self.from_email = os.environ['SES_EMAIL']
-        try:
-            self.template = env.get_template('email_template.html')
-            log.debug('email_template.html loaded into SES')
+        self.client = self.create_client(self.name, region_name='us-west-2')
+        #  Templates are compiled on startup rather than with the first notification
+        renderer.get_template(EMAIL_TEMPLATE)
 
-        except TemplateNotFound:
-            log.exception('Couldn\'t find email_template.html. Defaulting to text email message.')
-            self.template = None
+        #  Notifications about the same task group and recipients are sent as digests when PN_EMAIL_DIGEST_WINDOW is set
+        if DIGEST_WINDOW > 0:
+            self.digests = DigestBatcher(self.send_digest)
+        else:
+            self.digests = None
 
         log.info('{} plugin initialized.'.format(self.name))
 
     @async_time_me
     async def notify(self, task_data, status_config):
-        email_message = MIMEMultipart()
-        email_message['Subject'] = status_config['subject']
-        email_message['To'] = ', '.join(status_config['emails'])
-
-        if self.template:
-            log_destinations = (l['destination_url'] for l in task_data.log_data())
-            rendered_email = self.template.render(subject=status_config['subject'],
-                                                  body=status_config['message'],
-                                                  date=datetime.datetime.now().strftime('%b %d, %Y'),
-                                                  logs=log_destinations,
-                                                  inspector_url=task_data.inspector_url)
-            email_message.attach(MIMEText(rendered_email, 'html'))
+        #  Spooled notifications are sent on their own, they have already waited long enough. Other notifications
+        #  wait for their digest without holding up the worker.
+        if self.digests is not None and not task_data.spooled:
+            return self.digests.add(digest_key(task_data, status_config), (task_data, status_config))
         else:
-            email_message.attach(MIMEText(status_config['message'], 'text'))
+            await self.send_email(task_data, status_config)
+
+    async def send_email(self, task_data, status_config):
+        part = renderer.task_part(status_config['subject'], status_config['message'], task_data.inspector_url,
+                                  log_urls(task_data))
+        await self.send_message(status_config['subject'], part, task_data.task_group_id, status_config['emails'],
+                                repr(task_data))
+
+    async def send_digest(self, entries):
+        if len(entries) == 1:
+            await self.send_email(*entries[0])
+            return
 
+        task_data, status_config = entries[0]
+        subject = digest_subject(entries)
+        await self.send_message(subject, renderer.digest_part(subject, entries), task_data.task_group_id,
+                                status_config['emails'],
+                                'digest of {} tasks of group {}'.format(len(entries), task_data.task_group_id))
+
+    async def send_message(self, subject, part, task_group_id, recipients, description):
         #  Set headers to create email threads
-        thread_id = '<{task_group_id}@{thread_domain}>'.format(task_group_id=task_data.task_group_id,
+        thread_id = '<{task_group_id}@{thread_domain}>'.format(task_group_id=task_group_id,
                                                                thread_domain=os.environ.get('EMAIL_THREADING_DOMAIN',
                                                                                             'mozilla.com'))
-        email_message.add_header('In-Reply-To', thread_id)
-        email_message.add_header('References', thread_id)
-
-        for attempt in range(5):
-            try:
-                ses = boto3.client(self.name,
-                                   aws_access_key_id=self.access_key_id,
-                                   aws_secret_access_key=self.secret_access_key,
-                                   region_name='us-west-2')
-
-                raw_message = {'Data': email_message.as_string()}
+        raw_message = {'Data': build_email(subject, recipients, part,
+                                           headers=(('In-Reply-To', thread_id), ('References', thread_id)))}
 
-                ses.send_raw_email(RawMessage=raw_message,
+        async def send_raw_email():
+            await self.call_client('send_raw_email',
+                                   RawMessage=raw_message,
                                    Source=self.from_email,
-                                   Destinations=status_config['emails'])
+                                   Destinations=recipients)
+            return True
 
-                log.info('Notified with SES for %r', task_data)
-                return
-            except Boto3Error as b3e:
-                log.exception('SES attempt %s: Boto3Error - %s', str(attempt), b3e)
-        else:
-            log.exception('Could not notify via SES for %s', task_data)
+        #  Failed sends are retried with backoff. While the SES circuit is open, CircuitOpenError is raised straight
+        #  away and the notification is spooled.
+        try:
+            await retry_connection(send_raw_email)
+        except RetriesExceededError as e:
+            raise NotificationFailedError('Could not notify via SES for {}'.format(description)) from e
+        log.info('Notified with SES for %s', description)
+
+    async def close(self):
+        if self.digests is not None:
+            await self.digests.close()
@@ -1,19 +1,100 @@
 import smtplib
 import logging
-import datetime
 import os
+import queue
 
-from . import BasePlugin
-from smtplib import SMTPConnectError
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from jinja2 import PackageLoader, Environment, TemplateNotFound
-from pulsenotify.util import async_time_me
+from . import BasePlugin, LOGS_URLS, NotificationFailedError
+from smtplib import SMTPException, SMTPServerDisconnected
+from pulsenotify.mail import build_email, digest_key, digest_subject, log_urls, renderer, DigestBatcher
+from pulsenotify.mail import DIGEST_WINDOW, EMAIL_TEMPLATE
+from pulsenotify.util import async_time_me, circuit_breaker, retry_connection, run_blocking, RetriesExceededError
 
 
 log = logging.getLogger(__name__)
 
-env = Environment(loader=PackageLoader('pulsenotify', 'templates'))
+#  Number of authenticated SMTP sessions kept open between notifications
+POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', 2))
+
+
+class SMTPConnectionPool(object):
+    """
+    Pool of authenticated SMTP sessions to a single server.
+
+    Sessions are borrowed by executor threads for the duration of a send and returned afterwards, so sending an
+    email doesn't require a new connection, STARTTLS and LOGIN every time. Idle sessions are checked with NOOP
+    before being handed out, and replaced when the server has dropped them.
+    """
+    def __init__(self, host, port, user, passwd, size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def connect(self):
+        connection = smtplib.SMTP(self.host, self.port)
+        connection.ehlo()
+        connection.starttls()
+        connection.login(self.user, self.passwd)
+        log.debug('Opened new SMTP session to %s:%s', self.host, self.port)
+        return connection
+
+    def acquire(self):
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+
+            if self.is_alive(connection):
+                return connection
+            self.discard(connection)
+
+    def release(self, connection):
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            self.discard(connection)
+
+    @staticmethod
+    def is_alive(connection):
+        try:
+            return connection.noop()[0] == 250
+        except (SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def discard(connection):
+        try:
+            connection.quit()
+        except (SMTPException, OSError):
+            connection.close()
+
+    def sendmail(self, from_addr, to_addrs, message):
+        #  A pooled session can still be dropped by the server between the NOOP and the send, in which case the
+        #  email is sent again over a new session
+        connection = self.acquire()
+        try:
+            connection.sendmail(from_addr, to_addrs, message)
+        except SMTPServerDisconnected:
+            self.discard(connection)
+            connection = self.connect()
+            try:
+                connection.sendmail(from_addr, to_addrs, message)
+            except Exception:
+                self.discard(connection)
+                raise
+        except Exception:
+            self.discard(connection)
+            raise
+        self.release(connection)
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
 
 
 class Plugin(BasePlugin):
@@ -26,48 +107,68 @@ class Plugin(BasePlugin):
         - SMTP_HOST (SMTP host domain)
         - SMTP_PORT (port of host)
     """
+    logs_required = LOGS_URLS
+
     def __init__(self):
         self.email = os.environ['SMTP_EMAIL']
         self.passwd = os.environ['SMTP_PASSWD']
         self.host = os.environ['SMTP_HOST']
         self.port = os.environ['SMTP_PORT']
-        try:
-            self.template = env.get_template('email_template.html')
-            log.debug('email_template.html loaded into SES')
+        self.pool = SMTPConnectionPool(self.host, self.port, self.email, self.passwd)
+        self.breaker = circuit_breaker('{}:{}'.format(self.host, self.port))
+        #  Templates are compiled on startup rather than with the first notification
+        renderer.get_template(EMAIL_TEMPLATE)
 
-        except TemplateNotFound:
-            log.exception('Couldn\'t find email_template.html. Defaulting to text email message.')
-            self.template = None
+        #  Notifications about the same task group and recipients are sent as digests when PN_EMAIL_DIGEST_WINDOW is set
+        if DIGEST_WINDOW > 0:
+            self.digests = DigestBatcher(self.send_digest)
+        else:
+            self.digests = None
         log.info('%s plugin initialized', self.name)
 
     @async_time_me
     async def notify(self, task_data, exchange_config):
-        email_message = MIMEMultipart()
-        email_message['Subject'] = exchange_config['subject']
-        email_message['To'] = ', '.join(exchange_config['emails'])
-
-        if self.template:
-            log_destinations = (l['destination_url'] for l in task_data.log_data())
-            rendered_email = self.template.render(exchange_config,
-                                                  date=datetime.datetime.now().strftime('%b %d, %Y'),
-                                                  subject=exchange_config['subject'],
-                                                  body=exchange_config['message'],
-                                                  logs=log_destinations)
-            email_message.attach(MIMEText(rendered_email, 'html'))
+        #  Spooled notifications are sent on their own, they have already waited long enough. Other notifications
+        #  wait for their digest without holding up the worker.
+        if self.digests is not None and not task_data.spooled:
+            return self.digests.add(digest_key(task_data, exchange_config), (task_data, exchange_config))
         else:
-            email_message.attach(MIMEText(exchange_config['message'], 'text'))
+            await self.send_email(task_data, exchange_config)
 
-        for attempt in range(5):
-            try:
-                s = smtplib.SMTP(self.host, self.port)
-                s.ehlo()
-                s.starttls()
-                s.login(self.email, self.passwd)
-                s.sendmail(self.email, exchange_config['emails'], email_message.as_string())
-                s.quit()
-                log.info("Notified on smtp for %r", task_data)
-                return
-            except SMTPConnectError as ce:
-                log.exception('Attempt %s: SMTPConnectError %s', str(attempt), ce.message)
-        else:
-            log.exception('Could not connect to %s with login %s:%s for task %r', self.host, self.email, task_data)
+    async def send_email(self, task_data, exchange_config):
+        part = renderer.task_part(exchange_config['subject'], exchange_config['message'], task_data.inspector_url,
+                                  log_urls(task_data))
+        await self.send_message(exchange_config['subject'], part, exchange_config['emails'],
+                                'task {!r}'.format(task_data))
+
+    async def send_digest(self, entries):
+        if len(entries) == 1:
+            await self.send_email(*entries[0])
+            return
+
+        task_data, exchange_config = entries[0]
+        subject = digest_subject(entries)
+        await self.send_message(subject, renderer.digest_part(subject, entries), exchange_config['emails'],
+                                'digest of {} tasks of group {}'.format(len(entries), task_data.task_group_id))
+
+    async def send_message(self, subject, part, recipients, description):
+        email_message = build_email(subject, recipients, part)
+
+        async def sendmail():
+            with self.breaker:
+                await run_blocking(self.pool.sendmail, self.email, recipients, email_message)
+            return True
+
+        #  Failed sends are retried with backoff. While the server's circuit is open, CircuitOpenError is raised
+        #  straight away and the notification is spooled.
+        try:
+            await retry_connection(sendmail)
+        except RetriesExceededError as e:
+            raise NotificationFailedError('Could not connect to {} with login {} for {}'.format(
+                self.host, self.email, description)) from e
+        log.info("Notified on smtp for %s", description)
+
+    async def close(self):
+        if self.digests is not None:
+            await self.digests.close()
+        await run_blocking(self.pool.close)
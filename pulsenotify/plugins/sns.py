@@ -1,9 +1,7 @@
-from . import AWSPlugin
-import boto3
-from boto3.exceptions import Boto3Error
+from . import AWSPlugin, LOGS_URLS, NotificationFailedError
 import logging
 import os
-from pulsenotify.util import async_time_me
+from pulsenotify.util import async_time_me, retry_connection, RetriesExceededError
 
 log = logging.getLogger(__name__)
 
@@ -17,30 +15,32 @@ class Plugin(AWSPlugin):
         - AWS_SECRET_ACCESS_KEY
         - SNS_ARN
     """
+    logs_required = LOGS_URLS
+
     def __init__(self):
         super().__init__()
         self.arn = os.environ['SNS_ARN']
+        self.client = self.create_client(self.name, region_name='us-west-2')
 
     @async_time_me
     async def notify(self, task_data, exchange_config):
         """Perform the notification (ie email relevant addresses)"""
         message = exchange_config['message']
-        if task_data.logs() is not None:
+        if task_data.logs is not None:
             joined_logs = '\n'.join((l['destination_url'] for l in task_data.log_data()))
             message += "\nThere should be some logs at \n{}".format(joined_logs)
 
-        for attempt in range(5):
-            try:
-                sns = boto3.resource(self.name,
-                                     aws_access_key_id=self.access_key_id,
-                                     aws_secret_access_key=self.secret_access_key,
-                                     region_name='us-west-2')
-                topic = sns.Topic(self.arn)
-
-                topic.publish(Subject=exchange_config['subject'], Message=message)
-                log.info('Notified with SNS for %r', task_data)
-                return
-            except Boto3Error as b3e:
-                log.exception('Attempt %s: Boto3Error %s', str(attempt), b3e.message)
-        else:
-            log.exception('Could not notify %s via SNS for %r', self.arn, task_data)
+        async def publish():
+            await self.call_client('publish',
+                                   TopicArn=self.arn,
+                                   Subject=exchange_config['subject'],
+                                   Message=message)
+            return True
+
+        #  Failed publishes are retried with backoff. While the SNS circuit is open, CircuitOpenError is raised
+        #  straight away and the notification is spooled.
+        try:
+            await retry_connection(publish)
+        except RetriesExceededError as e:
+            raise NotificationFailedError('Could not notify {} via SNS for {!r}'.format(self.arn, task_data)) from e
+        log.info('Notified with SNS for %r', task_data)
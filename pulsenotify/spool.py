@@ -0,0 +1,188 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import time
+
+from pulsenotify import metrics
+from pulsenotify.util import backoff_delay, failed_permanently
+
+log = logging.getLogger(__name__)
+
+#  SQLite database notifications are kept in from when they are queued until they are delivered
+SPOOL_PATH = os.environ.get('PN_SPOOL_PATH', 'pulsenotify-spool.sqlite3')
+
+#  Spooled notifications are attempted up to PN_SPOOL_MAX_ATTEMPTS times, waiting a jittered delay doubling from
+#  PN_SPOOL_BASE_DELAY seconds up to PN_SPOOL_MAX_DELAY seconds between attempts. The spool is checked for
+#  notifications due to be retried every PN_SPOOL_POLL_INTERVAL seconds.
+SPOOL_MAX_ATTEMPTS = int(os.environ.get('PN_SPOOL_MAX_ATTEMPTS', 10))
+SPOOL_BASE_DELAY = float(os.environ.get('PN_SPOOL_BASE_DELAY', 30))
+SPOOL_MAX_DELAY = float(os.environ.get('PN_SPOOL_MAX_DELAY', 3600))
+SPOOL_POLL_INTERVAL = float(os.environ.get('PN_SPOOL_POLL_INTERVAL', 10))
+
+#  Maximum number of spooled notifications retried in one pass
+SPOOL_BATCH_SIZE = 50
+
+#  Notifications handed to a plugin queue are kept with 0 attempts until they are sent, and are not retried by the
+#  background task in the meantime
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    plugin TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt REAL NOT NULL,
+    last_error TEXT
+)
+'''
+
+
+class RetrySpool(object):
+    """
+    Durable queue of plugin notifications that failed, retried in the background.
+
+    Every notification is kept in the spool from when it is handed to its plugin's queue (see enqueue) until it is
+    sent, so a Pulse message can be acknowledged as soon as its notifications are queued without losing them if the
+    worker dies. A notification the plugin gave up on stays in the spool, and an outage of a notification service
+    doesn't hold up consumption. Entries are kept in a SQLite database, so they survive a restart of the worker, and
+    are retried with backoff by a background task until they are delivered or have been attempted max_attempts times.
+    Notifications that were still queued when the worker stopped are retried after the restart.
+
+    Database calls are blocking and run on a thread of their own.
+    """
+    def __init__(self, path=SPOOL_PATH, max_attempts=SPOOL_MAX_ATTEMPTS, base_delay=SPOOL_BASE_DELAY,
+                 max_delay=SPOOL_MAX_DELAY, poll_interval=SPOOL_POLL_INTERVAL):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self._connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._retrying = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args))
+
+    def _connect(self):
+        #  The database is only created once something is spooled or the spool is first checked. Notifications left
+        #  queued by the previous run of the worker were never sent, or not confirmed to be, and are due right away.
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            #  A notification is written and deleted for every notification sent, WAL keeps that cheap
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(SCHEMA)
+            recovered = self._connection.execute('UPDATE deliveries SET attempts = 1 WHERE attempts = 0').rowcount
+            if recovered:
+                log.warning('Recovered %s notifications queued before the worker stopped', recovered)
+        return self._connection
+
+    def _insert(self, plugin_name, entry, attempts, next_attempt, error):
+        return self._connect().execute('INSERT INTO deliveries (plugin, entry, attempts, next_attempt, last_error) '
+                                       'VALUES (?, ?, ?, ?, ?)',
+                                       (plugin_name, entry, attempts, next_attempt, error)).lastrowid
+
+    def _due(self, now, limit):
+        return self._connect().execute('SELECT id, plugin, entry, attempts FROM deliveries '
+                                       'WHERE attempts > 0 AND next_attempt <= ? ORDER BY next_attempt LIMIT ?',
+                                       (now, limit)).fetchall()
+
+    def _reschedule(self, delivery_id, attempts, next_attempt, error):
+        self._connect().execute('UPDATE deliveries SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?',
+                                (attempts, next_attempt, error, delivery_id))
+
+    def _delete(self, delivery_id):
+        self._connect().execute('DELETE FROM deliveries WHERE id = ?', (delivery_id,))
+
+    def _count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM deliveries WHERE attempts > 0').fetchone()[0]
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def next_attempt(self, attempts):
+        return time() + backoff_delay(attempts, self.base_delay, self.max_delay)
+
+    async def add(self, plugin_name, entry, error=None):
+        #  entry is everything the plugin needs to notify again, and must be JSON serializable
+        await self._run(self._insert, plugin_name, json.dumps(entry), 1, self.next_attempt(1), error)
+        metrics.spooled_notifications.inc(plugin=plugin_name, result='spooled')
+        log.info('Spooled %s notification to retry later', plugin_name)
+
+    async def enqueue(self, plugin_name, entry):
+        #  Keeps a notification handed to a plugin queue, and returns its id. The notification is removed once sent
+        #  (see remove), or scheduled to be retried if it fails (see failed).
+        return await self._run(self._insert, plugin_name, json.dumps(entry), 0, time(), None)
+
+    async def failed(self, delivery_id, plugin_name, error=None):
+        await self._run(self._reschedule, delivery_id, 1, self.next_attempt(1), error)
+        metrics.spooled_notifications.inc(plugin=plugin_name, result='spooled')
+        log.info('Spooled %s notification to retry later', plugin_name)
+
+    async def remove(self, delivery_id):
+        await self._run(self._delete, delivery_id)
+
+    async def pending(self):
+        return await self._run(self._count)
+
+    async def retry_due(self, deliver):
+        #  Calls deliver(plugin_name, entry) for each notification due to be retried. Delivered notifications leave
+        #  the spool, failed ones are rescheduled with backoff, or dropped once they have used all their attempts or
+        #  failed permanently.
+        for delivery_id, plugin_name, entry, attempts in await self._run(self._due, time(), SPOOL_BATCH_SIZE):
+            try:
+                await deliver(plugin_name, json.loads(entry))
+            except Exception as e:
+                attempts += 1
+                if failed_permanently(e):
+                    log.error('Dropping spooled %s notification %s, it failed permanently: %s',
+                              plugin_name, delivery_id, e)
+                    await self._run(self._delete, delivery_id)
+                    metrics.spooled_notifications.inc(plugin=plugin_name, result='dropped')
+                elif attempts >= self.max_attempts:
+                    log.error('Dropping spooled %s notification %s after %s attempts: %s',
+                              plugin_name, delivery_id, attempts, e)
+                    await self._run(self._delete, delivery_id)
+                    metrics.spooled_notifications.inc(plugin=plugin_name, result='dropped')
+                else:
+                    log.warning('Spooled %s notification %s failed again (attempt %s): %s',
+                                plugin_name, delivery_id, attempts, e)
+                    await self._run(self._reschedule, delivery_id, attempts, self.next_attempt(attempts), repr(e))
+            else:
+                log.info('Delivered spooled %s notification %s', plugin_name, delivery_id)
+                await self._run(self._delete, delivery_id)
+                metrics.spooled_notifications.inc(plugin=plugin_name, result='delivered')
+
+        metrics.spool_pending.set(await self.pending())
+
+    async def retry_periodically(self, deliver):
+        while True:
+            try:
+                await self.retry_due(deliver)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception('Could not retry spooled notifications: %s', e)
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self, deliver):
+        if self._retrying is None:
+            self._retrying = asyncio.ensure_future(self.retry_periodically(deliver))
+
+    async def close(self):
+        if self._retrying is not None:
+            self._retrying.cancel()
+            try:
+                await self._retrying
+            except asyncio.CancelledError:
+                pass
+            self._retrying = None
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,153 @@
+import logging
+import os
+import signal
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from pulsenotify.metrics import EXPOSITION_CONTENT_TYPE, METRICS_HOST, merge_snapshots, read_snapshots
+from pulsenotify.metrics import render_exposition
+
+log = logging.getLogger(__name__)
+
+#  Number of worker processes. With more than one, the main process becomes a supervisor forking the workers.
+WORKERS = int(os.environ.get('PN_WORKERS', 1))
+
+#  Directory the workers write their metrics snapshots to. Defaults to a temporary directory.
+METRICS_SNAPSHOT_DIR = os.environ.get('PN_METRICS_SNAPSHOT_DIR')
+
+#  Seconds workers have to finish the messages they are processing after being asked to stop, before being killed
+SHUTDOWN_TIMEOUT = int(os.environ.get('PN_SHUTDOWN_TIMEOUT', 60))
+
+#  Seconds to wait before replacing a worker that exited unexpectedly
+RESTART_DELAY = 1
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Supervisor(object):
+    """
+    Forks worker processes and keeps them running.
+
+    Each worker runs its own event loop and AMQP connection, consuming from the same Pulse queue, so the CPU-bound
+    parts of processing messages can use every core. A worker exiting unexpectedly is replaced. On SIGTERM or SIGINT
+    the workers are asked to stop with SIGTERM, finishing the messages they already received, and are killed if they
+    haven't exited after SHUTDOWN_TIMEOUT seconds.
+
+    Workers write snapshots of their metrics to snapshot_dir, and the supervisor serves their sum on
+    metrics_port when set.
+    """
+    def __init__(self, workers, run_worker, snapshot_dir=METRICS_SNAPSHOT_DIR, metrics_port=None,
+                 metrics_host=METRICS_HOST, shutdown_timeout=SHUTDOWN_TIMEOUT):
+        self.workers = workers
+        self.run_worker = run_worker
+        self.snapshot_dir = snapshot_dir or tempfile.mkdtemp(prefix='pulsenotify-metrics-')
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.shutdown_timeout = shutdown_timeout
+        self.children = {}
+        self.stopping = False
+        self.metrics_server = None
+
+    def snapshot_path(self, worker_id):
+        return os.path.join(self.snapshot_dir, '{}.json'.format(worker_id))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        if self.metrics_port is not None:
+            self.serve_metrics()
+
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            worker_id = self.children.pop(pid, None)
+            if worker_id is None:
+                continue
+            try:
+                os.remove(self.snapshot_path(worker_id))
+            except OSError:
+                pass
+
+            if not self.stopping:
+                log.error('Worker %s (pid %s) exited with status %s, restarting it', worker_id, pid, status)
+                time.sleep(RESTART_DELAY)
+                self.spawn(worker_id)
+            else:
+                log.info('Worker %s (pid %s) stopped', worker_id, pid)
+
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        log.info('All workers stopped.')
+
+    def spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            #  The worker handles SIGTERM itself, and is stopped by the supervisor on SIGINT
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            if self.metrics_server is not None:
+                self.metrics_server.socket.close()
+
+            exit_code = 1
+            try:
+                self.run_worker(worker_id, self.snapshot_path(worker_id))
+                exit_code = 0
+            except Exception:
+                log.exception('Worker %s failed', worker_id)
+            finally:
+                logging.shutdown()
+                os._exit(exit_code)
+
+        log.info('Started worker %s (pid %s)', worker_id, pid)
+        self.children[pid] = worker_id
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        log.info('Stopping %s workers', len(self.children))
+        self.stopping = True
+        for pid in list(self.children):
+            os.kill(pid, signal.SIGTERM)
+        signal.alarm(self.shutdown_timeout)
+
+    def kill(self, signum, frame):
+        for pid, worker_id in list(self.children.items()):
+            log.error('Worker %s (pid %s) did not stop in %ss, killing it', worker_id, pid, self.shutdown_timeout)
+            os.kill(pid, signal.SIGKILL)
+
+    def serve_metrics(self):
+        snapshot_dir = self.snapshot_dir
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render_exposition(merge_snapshots(read_snapshots(snapshot_dir))).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', EXPOSITION_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        self.metrics_server = _ThreadingHTTPServer((self.metrics_host, self.metrics_port), MetricsHandler)
+        thread = threading.Thread(target=self.metrics_server.serve_forever, name='metrics', daemon=True)
+        thread.start()
+        log.info('Serving metrics of %s workers on %s:%s', self.workers, self.metrics_host, self.metrics_port)
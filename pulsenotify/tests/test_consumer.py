@@ -1,5 +1,5 @@
 import pytest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 
 @pytest.fixture()
@@ -38,19 +38,593 @@ class TestConsumer:
             assert service in consumer.notifiers
         assert hasattr(consumer, 'routing_keys')
         assert hasattr(consumer, 'exchanges')
+        assert consumer.max_in_flight >= 1
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.acked = []
+        self.requeued = []
+
+    async def basic_client_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    async def basic_client_nack(self, delivery_tag, multiple=False, requeue=True):
+        assert requeue
+        self.requeued.append(delivery_tag)
+
+
+class FakeTaskCache(object):
+    """ Serves the same task definition for every task, or fails with error """
+    def __init__(self, definition=None, error=None):
+        self.definition = {'extra': {}} if definition is None else definition
+        self.error = error
+
+    async def fetch_task(self, task_id, session):
+        if self.error is not None:
+            raise self.error
+        return self.definition
+
+
+class FakeSpool(object):
+    def __init__(self):
+        self.queued = {}
+        self.spooled = []
+
+    async def add(self, plugin_name, entry, error=None):
+        self.spooled.append(plugin_name)
+
+    async def enqueue(self, plugin_name, entry):
+        delivery_id = len(self.queued) + len(self.spooled) + 1
+        self.queued[delivery_id] = plugin_name
+        return delivery_id
+
+    async def failed(self, delivery_id, plugin_name, error=None):
+        self.spooled.append(self.queued.pop(delivery_id))
+
+    async def remove(self, delivery_id):
+        del self.queued[delivery_id]
+
+
+class FakeConsumption(object):
+    def __init__(self):
+        self.calls = []
+
+    async def start(self):
+        self.calls.append('start')
+
+    async def stop(self):
+        self.calls.append('stop')
+
+
+def _consumer(**attributes):
+    #  A consumer without plugins, connections or files, for the tests to set up what they need
+    from pulsenotify.consumer import NotifyConsumer
+    from pulsenotify.dedup import DedupIndex
+    consumer = NotifyConsumer.__new__(NotifyConsumer)
+    consumer.notifiers = {}
+    consumer.plugin_queues = {}
+    consumer._in_flight = set()
+    consumer._batched = set()
+    consumer.task_cache = FakeTaskCache()
+    consumer.http_session = None
+    consumer.spool = FakeSpool()
+    consumer.dedup = DedupIndex(path=None)
+    consumer.consumption = FakeConsumption()
+    consumer.paused = False
+    consumer.holding_off = False
+    consumer.stopping = False
+    for name, value in attributes.items():
+        setattr(consumer, name, value)
+    return consumer
+
+
+@pytest.mark.asyncio
+async def test_dispatch_bounds_messages_in_flight_and_releases_slots():
+    import asyncio
+
+    consumer = _consumer(max_in_flight=2, _in_flight_slots=asyncio.Semaphore(2))
+    channel = FakeChannel()
+    running = set()
+    peak = []
+
+    async def slow_process(channel, body, envelope, properties, received_at):
+        running.add(body)
+        peak.append(len(running))
+        await asyncio.sleep(0.05)
+        running.discard(body)
+        await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+        if body == b'fail':
+            raise RuntimeError('processing failed')
+
+    consumer.process = slow_process
+    for delivery_tag, body in enumerate([b'first', b'fail', b'third', b'fourth']):
+        envelope = MagicMock()
+        envelope.delivery_tag = delivery_tag
+        await consumer.dispatch(channel, body, envelope, object())
+    await consumer.drain()
+
+    assert max(peak) == 2
+    assert sorted(channel.acked) == [0, 1, 2, 3]
+
+    #  Every slot was released, including the one of the message that raised
+    assert consumer.in_flight == 0
+    for _ in range(consumer.max_in_flight):
+        await asyncio.wait_for(consumer._in_flight_slots.acquire(), 0.01)
+
+
+@pytest.mark.asyncio
+async def test_process_acknowledges_message_when_processing_fails(aws_task_data):
+    from json import dumps
+
+    consumer = _consumer(generate_notification_configurations=MagicMock(side_effect=RuntimeError('unexpected')))
+    channel = FakeChannel()
+    aws_task_data.envelope.delivery_tag = 7
+
+    await consumer.process(channel, dumps(aws_task_data.body).encode('utf-8'), aws_task_data.envelope, object())
+
+    assert channel.acked == [7]
+    #  The message is processed again if it is delivered again
+    assert len(consumer.dedup) == 0
 
 
 @pytest.mark.asyncio
-async def test_get_log():
-    from pulsenotify.consumer import get_log
-    bbb_log_url = 'https://queue.taskcluster.net/v1/task/33L76kSaRryFXFsiwzYo2w/runs/0/artifacts/public/properties.json'
-    aws_log_url = 'https://queue.taskcluster.net/v1/task/QWfpy1x1RXWr2aEiFiHkww/runs/0/artifacts/public/logs/live.log'
+async def test_process_requeues_message_and_holds_off_while_circuit_is_open(aws_task_data):
+    import asyncio
+    from json import dumps
+    from pulsenotify.util import CircuitOpenError
+
+    consumer = _consumer(task_cache=FakeTaskCache(
+        error=CircuitOpenError('Circuit open for queue.taskcluster.net', retry_after=0.05)))
+    channel = FakeChannel()
+    aws_task_data.envelope.delivery_tag = 7
+
+    await consumer.process(channel, dumps(aws_task_data.body).encode('utf-8'), aws_task_data.envelope, object())
+    await asyncio.sleep(0)
+
+    assert channel.acked == []
+    assert channel.requeued == [7]
+    assert consumer.holding_off
+    assert consumer.consumption.calls == ['stop']
+
+    #  Consumption restarts once the breaker lets a probe through, at least a second later
+    with patch('pulsenotify.consumer.asyncio.get_event_loop') as get_event_loop:
+        consumer.holding_off = False
+        consumer.hold_off(0.05)
+        delay, callback = get_event_loop.return_value.call_later.call_args[0]
+    assert delay == 1
+    callback()
+    await asyncio.sleep(0)
+    assert not consumer.holding_off
+    assert consumer.consumption.calls == ['stop', 'stop', 'start']
+
+    #  But not when the hold-off ends once shutdown has begun
+    with patch('pulsenotify.consumer.asyncio.get_event_loop') as get_event_loop:
+        consumer.hold_off(0.05)
+        delay, callback = get_event_loop.return_value.call_later.call_args[0]
+    consumer.stopping = True
+    callback()
+    await asyncio.sleep(0)
+    assert consumer.consumption.calls == ['stop', 'stop', 'start', 'stop']
+
+
+@pytest.mark.asyncio
+async def test_notify_plugin_spools_only_transient_failures(aws_task_data):
+    from pulsenotify.plugins import NotificationFailedError
+    from pulsenotify.util import PermanentFailureError, RetriesExceededError
+
+    class FailingPlugin(object):
+        async def notify(self, task_data, config):
+            raise NotificationFailedError('Could not notify') from self.error
+
+    plugin = FailingPlugin()
+    consumer = _consumer(notifiers={'ses': plugin})
+
+    plugin.error = PermanentFailureError()
+    await consumer.notify_plugin('ses', aws_task_data, {})
+    assert consumer.spool.spooled == []
+
+    plugin.error = RetriesExceededError()
+    await consumer.notify_plugin('ses', aws_task_data, {})
+    assert consumer.spool.spooled == ['ses']
+
+
+class StubResponse(object):
+    def __init__(self, payload):
+        self.payload = payload
+        self.headers = {}
+
+    def raise_for_status(self):
+        pass
+
+    async def json(self):
+        return self.payload
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+class StubSession(object):
+    """Stands in for the shared aiohttp session, answering every GET with payload"""
+    def __init__(self, payload=None):
+        self.payload = payload
+        self.requested = []
+
+    def get(self, url):
+        self.requested.append(url)
+        return StubResponse(self.payload)
+
+
+@pytest.mark.asyncio
+async def test_resolve_log_url():
+    from pulsenotify.consumer import resolve_log_url
+    bbb_properties_url = 'https://queue.example.com/v1/task/33L76kSaRryFXFsiwzYo2w/runs/0/properties.json'
+    aws_log_url = 'https://queue.example.com/v1/task/QWfpy1x1RXWr2aEiFiHkww/runs/0/artifacts/public/logs/live.log'
+    session = StubSession({'log_url': ['https://logs.example.com/33L76kSaRryFXFsiwzYo2w.log']})
+
+    #  buildbot-bridge logs are found in the build properties, aws-provisioner logs are downloaded as they are
+    assert await resolve_log_url(bbb_properties_url, 'buildbot-bridge', session) == \
+        'https://logs.example.com/33L76kSaRryFXFsiwzYo2w.log'
+    assert await resolve_log_url(aws_log_url, 'aws-provisioner-v1', session) == aws_log_url
+    assert await resolve_log_url(aws_log_url, 'unknown-provisioner', session) is None
+    assert session.requested == [bbb_properties_url]
+
+
+@pytest.mark.asyncio
+async def test_resolve_log_url_without_bbb_log():
+    from pulsenotify.consumer import resolve_log_url, NoLogsExistError
+    properties_url = 'https://queue.example.com/v1/task/33L76kSaRryFXFsiwzYo2w/runs/0/artifacts/public/properties.json'
+
+    with pytest.raises(NoLogsExistError):
+        await resolve_log_url(properties_url, 'buildbot-bridge', StubSession({}))
+
+
+def test_open_log_uses_task_session(aws_task_data):
+    aws_task_data.session = StubSession('some log')
+
+    response = aws_task_data.open_log('https://logs.example.com/live.log')
+
+    assert isinstance(response, StubResponse)
+    assert aws_task_data.session.requested == ['https://logs.example.com/live.log']
+
+
+@pytest.fixture()
+def aws_task_data(task_ids):
+    from pulsenotify.consumer import TaskData
+    from json import dumps
+    body = dumps({
+        'status': {
+            'taskId': task_ids['REAL_TASK'],
+            'provisionerId': 'aws-provisioner-v1',
+            'taskGroupId': task_ids['REAL_TASK'],
+            'runs': [{'runId': 0}, {'runId': 1}],
+        }
+    }).encode('utf-8')
+    envelope = MagicMock()
+    envelope.exchange_name = 'exchange/taskcluster-queue/v1/task-failed'
+
+    return TaskData(body, envelope, object())
+
+
+@pytest.mark.asyncio
+async def test_fetch_logs_skipped_when_no_plugin_needs_them(aws_task_data):
+    from pulsenotify.plugins import LOGS_NONE
+
+    await aws_task_data.fetch_logs(LOGS_NONE)
+
+    assert aws_task_data.logs is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_logs_lists_runs_without_downloading(aws_task_data):
+    from pulsenotify.plugins import LOGS_URLS
+
+    aws_task_data.session = MagicMock()
+    await aws_task_data.fetch_logs(LOGS_URLS)
+
+    assert aws_task_data.logs == [(0, None), (1, None)]
+    assert not aws_task_data.session.get.called
+
+
+@pytest.mark.asyncio
+async def test_fetch_logs_resolves_runs_concurrently_in_run_order(aws_task_data):
+    import asyncio
+    from unittest.mock import patch
+    from pulsenotify.plugins import LOGS_BODIES
+
+    async def slow_first_run(url, provisioner_id, session):
+        await asyncio.sleep(0.1 if '/runs/0/' in url else 0)
+        return url
+
+    with patch('pulsenotify.consumer.resolve_log_url', new=slow_first_run):
+        await aws_task_data.fetch_logs(LOGS_BODIES)
+
+    assert [run_id for run_id, _ in aws_task_data.logs] == [0, 1]
+    assert '/runs/1/' in aws_task_data.logs[1][1]
+
+
+@pytest.mark.asyncio
+async def test_fetch_logs_overlaps_lookups_up_to_the_limit(aws_task_data):
+    import asyncio
+    from unittest.mock import patch
+    from pulsenotify.plugins import LOGS_BODIES
+
+    running = []
+    overlapping = []
+
+    async def slow_lookup(url, provisioner_id, session):
+        running.append(url)
+        overlapping.append(len(running))
+        await asyncio.sleep(0.05)
+        running.remove(url)
+        return url
+
+    aws_task_data.body['status']['runs'] = [{'runId': run_id} for run_id in range(4)]
+    with patch('pulsenotify.consumer.resolve_log_url', new=slow_lookup), \
+            patch('pulsenotify.consumer.LOG_FETCH_CONCURRENCY', 2):
+        await aws_task_data.fetch_logs(LOGS_BODIES)
+
+    #  Two lookups are in flight at a time, never more
+    assert max(overlapping) == 2
+    assert [run_id for run_id, _ in aws_task_data.logs] == [0, 1, 2, 3]
+
+
+def test_notification_configurations_only_include_referenced_ids():
+    consumer = _consumer()
+    consumer.identities = consumer.compile_identities({
+        'default': {},
+        'releasetasks': {'plugins': ['ses'], 'emails': ['release@example.com']},
+        'unused': {'plugins': ['irc']},
+    })
+    task_data = MagicMock()
+    task_data.status = 'task-failed'
+    task_data.definition = {'extra': {'notifications': {'task-failed': {
+        'message': 'failed',
+        'plugins': ['irc'],
+        'ids': ['releasetasks', 'not-configured'],
+    }}}}
+
+    notify_sections = consumer.generate_notification_configurations(task_data)
+
+    assert list(notify_sections) == ['default', 'releasetasks']
+    assert notify_sections['default']['plugins'] == ['irc']
+    assert notify_sections['releasetasks']['plugins'] == ('ses',)
+    assert notify_sections['releasetasks']['message'] == 'failed'
+
+
+@pytest.mark.asyncio
+async def test_process_notifies_plugins_concurrently_and_isolates_failures(aws_task_data):
+    import asyncio
+    from json import dumps
+    from pulsenotify.consumer import PluginQueue
+    from pulsenotify.plugins import LOGS_NONE
+
+    release = asyncio.Event()
+    started = []
+
+    class SlowPlugin(object):
+        logs_required = LOGS_NONE
+
+        def __init__(self):
+            self.notified = []
+
+        async def notify(self, task_data, exchange_config):
+            started.append(self)
+            await release.wait()
+            self.notified.append(exchange_config['message'])
+
+    class FailingPlugin(SlowPlugin):
+        async def notify(self, task_data, exchange_config):
+            raise ConnectionError('down')
+
+    consumer = _consumer(notifiers={'first': SlowPlugin(), 'second': SlowPlugin(), 'failing': FailingPlugin()},
+                         task_cache=FakeTaskCache({'extra': {'notifications': {'task-failed': {
+                             'message': 'failed', 'plugins': ['first', 'failing', 'second'],
+                         }}}}))
+    consumer.identities = consumer.compile_identities({'default': {}})
+    consumer.plugin_queues = {name: PluginQueue(name, consumer.notify_plugin, 1) for name in consumer.notifiers}
+    channel = FakeChannel()
+    aws_task_data.envelope.delivery_tag = 7
+
+    await consumer.process(channel, dumps(aws_task_data.body).encode('utf-8'), aws_task_data.envelope, object())
+
+    #  The message is acknowledged once its notifications are queued, and they are kept in the spool until sent. Both
+    #  slow plugins are notified at the same time, and the failed notification is left in the spool to be retried.
+    assert channel.acked == [7]
+    for _ in range(100):
+        if len(started) == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert len(started) == 2
+    assert sorted(consumer.spool.queued.values()) == ['first', 'second']
+    assert consumer.spool.spooled == ['failing']
+    release.set()
+    await consumer.drain()
+    assert consumer.notifiers['first'].notified == ['failed']
+    assert consumer.notifiers['second'].notified == ['failed']
+    assert consumer.spool.queued == {}
+
+    #  The same message delivered again is acknowledged without notifying anyone
+    await consumer.process(channel, dumps(aws_task_data.body).encode('utf-8'), aws_task_data.envelope, object())
+    await consumer.drain()
+    assert channel.acked == [7, 7]
+    assert consumer.notifiers['first'].notified == ['failed']
+
+    for plugin_queue in consumer.plugin_queues.values():
+        await plugin_queue.close()
+
+
+@pytest.mark.asyncio
+async def test_slow_plugin_does_not_hold_up_messages_for_other_plugins(aws_task_data):
+    import asyncio
+    from json import dumps
+    from unittest.mock import MagicMock
+    from pulsenotify.consumer import PluginQueue
+    from pulsenotify.plugins import LOGS_NONE
+
+    release = asyncio.Event()
+
+    class Plugin(object):
+        logs_required = LOGS_NONE
+
+        def __init__(self, blocked):
+            self.blocked = blocked
+            self.notified = []
+
+        async def notify(self, task_data, exchange_config):
+            if self.blocked:
+                await release.wait()
+            self.notified.append(task_data.envelope.delivery_tag)
+
+    class RoutingTaskCache(object):
+        #  Even tasks notify the stuck plugin, odd ones the other
+        async def fetch_task(self, task_id, session):
+            return {'extra': {'notifications': {'task-failed': {
+                'message': 'failed', 'plugins': ['fast' if int(task_id[-1]) % 2 else 'stuck'],
+            }}}}
+
+    consumer = _consumer(notifiers={'stuck': Plugin(blocked=True), 'fast': Plugin(blocked=False)},
+                         task_cache=RoutingTaskCache(), max_in_flight=2, _in_flight_slots=asyncio.Semaphore(2))
+    consumer.identities = consumer.compile_identities({'default': {}})
+    consumer.plugin_queues = {name: PluginQueue(name, consumer.notify_plugin, 1, maxsize=10,
+                                                on_full=consumer.pause, on_drained=consumer.resume)
+                              for name in consumer.notifiers}
+    channel = FakeChannel()
+
+    #  Twice as many stuck notifications as there are in-flight slots, interleaved with the others
+    for delivery_tag in range(8):
+        aws_task_data.body['status']['taskId'] = 'task{}'.format(delivery_tag)
+        envelope = MagicMock()
+        envelope.delivery_tag = delivery_tag
+        envelope.exchange_name = aws_task_data.envelope.exchange_name
+        await consumer.dispatch(channel, dumps(aws_task_data.body).encode('utf-8'), envelope, object())
+    for _ in range(100):
+        if len(channel.acked) == 8:
+            break
+        await asyncio.sleep(0.01)
+    assert sorted(channel.acked) == list(range(8))
+
+    assert consumer.notifiers['fast'].notified == [1, 3, 5, 7]
+    assert consumer.notifiers['stuck'].notified == []
+    assert not consumer.paused
+
+    release.set()
+    await consumer.drain()
+    assert consumer.notifiers['stuck'].notified == [0, 2, 4, 6]
+    for plugin_queue in consumer.plugin_queues.values():
+        await plugin_queue.close()
+
+
+@pytest.mark.asyncio
+async def test_digest_collects_more_messages_than_are_in_flight(aws_task_data):
+    import asyncio
+    from json import dumps
+    from unittest.mock import MagicMock
+    from pulsenotify.consumer import PluginQueue
+    from pulsenotify.mail import DigestBatcher
+    from pulsenotify.plugins import LOGS_NONE
+
+    class DigestPlugin(object):
+        logs_required = LOGS_NONE
+
+        def __init__(self):
+            self.digests = DigestBatcher(self.send_digest, window=0.1, max_size=100)
+            self.sent = []
+
+        async def notify(self, task_data, exchange_config):
+            return self.digests.add(task_data.task_group_id, task_data.envelope.delivery_tag)
+
+        async def send_digest(self, entries):
+            self.sent.append(sorted(entries))
+
+    plugin = DigestPlugin()
+    consumer = _consumer(notifiers={'ses': plugin}, max_in_flight=2, _in_flight_slots=asyncio.Semaphore(2),
+                         task_cache=FakeTaskCache({'extra': {'notifications': {'task-failed': {
+                             'message': 'failed', 'plugins': ['ses'],
+                         }}}}))
+    consumer.identities = consumer.compile_identities({'default': {}})
+    consumer.plugin_queues = {'ses': PluginQueue('ses', consumer.notify_plugin, 1)}
+    channel = FakeChannel()
+
+    #  Three times as many messages as there are in-flight slots, all within one window
+    for delivery_tag in range(6):
+        aws_task_data.body['status']['taskId'] = 'task{}'.format(delivery_tag)
+        envelope = MagicMock()
+        envelope.delivery_tag = delivery_tag
+        envelope.exchange_name = aws_task_data.envelope.exchange_name
+        await consumer.dispatch(channel, dumps(aws_task_data.body).encode('utf-8'), envelope, object())
+    await consumer.drain()
+
+    #  Every message is acknowledged while its notification waits for the digest, in the spool
+    assert sorted(channel.acked) == list(range(6))
+    assert plugin.sent == []
+    assert len(consumer.spool.queued) == 6
+
+    await plugin.digests.close()
+    await asyncio.wait(list(consumer._batched))
+    assert plugin.sent == [list(range(6))]
+    assert consumer.spool.queued == {}
+    await consumer.plugin_queues['ses'].close()
+
+
+@pytest.mark.asyncio
+async def test_full_plugin_queue_pauses_consumption_until_drained():
+    import asyncio
+    from pulsenotify.consumer import PluginQueue
+
+    release = asyncio.Event()
+
+    async def blocked_send(*args):
+        await release.wait()
+
+    consumer = _consumer()
+    plugin_queue = PluginQueue('smtp', blocked_send, workers=1, maxsize=2,
+                               on_full=consumer.pause, on_drained=consumer.resume)
+    consumer.plugin_queues = {'smtp': plugin_queue}
+
+    #  One notification being sent and two waiting fill the queue, the next one has to wait for room
+    for _ in range(3):
+        await plugin_queue.put()
+    await asyncio.sleep(0)
+    waiting = asyncio.ensure_future(plugin_queue.put())
+    await asyncio.sleep(0)
+    assert consumer.paused
+    assert not waiting.done()
+
+    release.set()
+    await plugin_queue.close()
+    assert waiting.done()
+    assert not consumer.paused
+    assert consumer.consumption.calls == ['stop', 'start']
+
+
+@pytest.mark.asyncio
+async def test_queues_drained_during_shutdown_do_not_resume_consumption():
+    import asyncio
+    from pulsenotify.consumer import PluginQueue
+
+    release = asyncio.Event()
 
-    artifact_bbb = await get_log(bbb_log_url, 'buildbot-bridge')
-    artifact_aws = await get_log(aws_log_url, 'aws-provisioner-v1')
+    async def blocked_send(*args):
+        await release.wait()
 
-    assert type(artifact_bbb) is str
-    assert '33L76kSaRryFXFsiwzYo2w' in str(artifact_bbb)
+    consumer = _consumer()
+    plugin_queue = PluginQueue('smtp', blocked_send, workers=1, maxsize=1,
+                               on_full=consumer.pause, on_drained=consumer.resume)
+    consumer.plugin_queues = {'smtp': plugin_queue}
+    for _ in range(2):
+        await plugin_queue.put()
+    await asyncio.sleep(0)
+    waiting = asyncio.ensure_future(plugin_queue.put())
+    await asyncio.sleep(0)
+    assert consumer.paused
 
-    assert type(artifact_aws) is str
-    assert 'QWfpy1x1RXWr2aEiFiHkww' in str(artifact_aws)
+    #  Shutdown drains the queues once consumption is stopped
+    consumer.stopping = True
+    release.set()
+    await waiting
+    await plugin_queue.close()
+    assert consumer.consumption.calls == ['stop']
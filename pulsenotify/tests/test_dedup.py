@@ -0,0 +1,52 @@
+from unittest.mock import patch
+
+from pulsenotify.dedup import DedupIndex
+
+
+def test_recognizes_duplicates():
+    index = DedupIndex(path=None)
+    assert not index.seen(('task1', 0, 'exchange/taskcluster-queue/v1/task-failed'))
+    index.add(('task1', 0, 'exchange/taskcluster-queue/v1/task-failed'))
+    assert index.seen(('task1', 0, 'exchange/taskcluster-queue/v1/task-failed'))
+    assert not index.seen(('task1', 1, 'exchange/taskcluster-queue/v1/task-failed'))
+    assert not index.seen(('task1', 0, 'exchange/taskcluster-queue/v1/task-exception'))
+
+
+def test_forgets_expired_and_oldest_keys():
+    index = DedupIndex(path=None, size=2, ttl=60)
+    with patch('pulsenotify.dedup.time', return_value=1000):
+        index.add('task1')
+        index.add('task2')
+        index.add('task3')
+        assert len(index) == 2
+        assert not index.seen('task1')
+
+    with patch('pulsenotify.dedup.time', return_value=1061):
+        index.add('task4')
+        assert not index.seen('task3')
+        assert len(index) == 1
+
+
+def test_persists_across_restarts(tmpdir):
+    path = str(tmpdir.join('dedup.json'))
+    index = DedupIndex(path=path)
+    index.add(('task1', 0, 'exchange/taskcluster-queue/v1/task-failed'))
+    index.save()
+
+    restarted = DedupIndex(path=path)
+    assert restarted.seen(('task1', 0, 'exchange/taskcluster-queue/v1/task-failed'))
+    assert not restarted.seen(('task2', 0, 'exchange/taskcluster-queue/v1/task-failed'))
+
+
+def test_saves_periodically_when_keys_are_added(tmpdir):
+    path = str(tmpdir.join('dedup.json'))
+    with patch('pulsenotify.dedup.time', return_value=1000):
+        index = DedupIndex(path=path, save_interval=10)
+        index.add(('task1', 0))
+        assert not DedupIndex(path=path).seen(('task1', 0))
+
+    with patch('pulsenotify.dedup.time', return_value=1010):
+        index.add(('task2', 0))
+        restarted = DedupIndex(path=path)
+        assert restarted.seen(('task1', 0))
+        assert restarted.seen(('task2', 0))
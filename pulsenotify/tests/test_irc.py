@@ -11,3 +11,148 @@ class TestIRC:
     @pytest.mark.asyncio
     async def test_constructor(self, plugin):
         assert hasattr(plugin, 'notify')
+
+
+class FakeIRCClient(object):
+    """ Records the lines sent, and confirms JOINs the way the server echoes them """
+    def __init__(self):
+        self.sent = []
+        self.connected = True
+        self.refused = set()
+        self.send_queue = None
+
+    def send(self, command, **kwargs):
+        if not self.connected:
+            raise RuntimeError('Not connected')
+        self.sent.append((command, kwargs))
+        if command == 'JOIN' and kwargs['channel'] not in self.refused:
+            self.send_queue.confirm_join(kwargs['channel'])
+
+    def trigger(self, event, **kwargs):
+        pass
+
+
+def _send_queue(client, registered=True, **kwargs):
+    from pulsenotify.plugins.irc import IRCSendQueue
+    kwargs.setdefault('rate', 1000)
+    kwargs.setdefault('burst', 10)
+    send_queue = client.send_queue = IRCSendQueue(client, **kwargs)
+    if registered:
+        send_queue.registered.set()
+    return send_queue
+
+
+async def _wait_until_sent(send_queue):
+    import asyncio
+    while send_queue.pending:
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_send_queue_joins_channels_once_and_coalesces_lines():
+    client = FakeIRCClient()
+    send_queue = _send_queue(client, max_line_length=40)
+
+    send_queue.put(['#releng'], ['task1: failed', 'task2: failed'])
+    send_queue.put(['#releng'], ['task3: failed'])
+    await _wait_until_sent(send_queue)
+    await send_queue.close()
+
+    assert client.sent == [
+        ('JOIN', {'channel': '#releng'}),
+        ('PRIVMSG', {'target': '#releng', 'message': 'task1: failed | task2: failed'}),
+        ('PRIVMSG', {'target': '#releng', 'message': 'task3: failed'}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_send_queue_waits_for_registration():
+    import asyncio
+    client = FakeIRCClient()
+    send_queue = _send_queue(client, registered=False)
+
+    send_queue.put(['#releng'], ['task1: failed'])
+    await asyncio.sleep(0.05)
+    assert client.sent == []
+
+    send_queue.registered.set()
+    await _wait_until_sent(send_queue)
+    await send_queue.close()
+
+    assert client.sent == [
+        ('JOIN', {'channel': '#releng'}),
+        ('PRIVMSG', {'target': '#releng', 'message': 'task1: failed'}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_send_queue_keeps_lines_until_reconnected():
+    import asyncio
+    client = FakeIRCClient()
+    client.connected = False
+    send_queue = _send_queue(client)
+
+    send_queue.put(['#releng'], ['task1: failed'])
+    await asyncio.sleep(0.05)
+    assert client.sent == []
+    assert not send_queue.registered.is_set()
+
+    client.connected = True
+    send_queue.registered.set()
+    await _wait_until_sent(send_queue)
+    await send_queue.close()
+
+    assert client.sent == [
+        ('JOIN', {'channel': '#releng'}),
+        ('PRIVMSG', {'target': '#releng', 'message': 'task1: failed'}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_send_queue_drops_lines_for_channels_it_could_not_join():
+    from unittest.mock import patch
+    client = FakeIRCClient()
+    client.refused.add('#private')
+    send_queue = _send_queue(client)
+
+    with patch('pulsenotify.plugins.irc.JOIN_TIMEOUT', 0.05):
+        send_queue.put(['#private', '#releng'], ['task1: failed'])
+        await _wait_until_sent(send_queue)
+    await send_queue.close()
+
+    assert send_queue.joined == {'#releng'}
+    assert client.sent == [
+        ('JOIN', {'channel': '#private'}),
+        ('JOIN', {'channel': '#releng'}),
+        ('PRIVMSG', {'target': '#releng', 'message': 'task1: failed'}),
+    ]
+
+
+def test_full_send_queue_fails_the_notification():
+    from pulsenotify.plugins import NotificationFailedError
+    send_queue = _send_queue(FakeIRCClient(), registered=False, max_pending_lines=3)
+
+    with pytest.raises(NotificationFailedError):
+        send_queue.put(['#releng', '#taskcluster'], ['task1: failed', 'log'])
+    assert send_queue.pending_lines == 0
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_paces_after_burst():
+    from time import monotonic
+    from pulsenotify.plugins.irc import TokenBucket
+    bucket = TokenBucket(rate=20, capacity=2)
+
+    started = monotonic()
+    for _ in range(4):
+        await bucket.take()
+
+    #  Two tokens are available straight away, the next two take 1/20s each
+    assert 0.09 <= monotonic() - started < 0.5
+
+
+def test_worker_nick_is_unique_per_worker():
+    from pulsenotify.plugins.irc import worker_nick
+    assert worker_nick('pulsenotify') == 'pulsenotify'
+    assert worker_nick('pulsenotify', '0') == 'pulsenotify-0'
+    assert worker_nick('pulsenotify', '1') != worker_nick('pulsenotify', '0')
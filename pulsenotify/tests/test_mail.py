@@ -0,0 +1,110 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+
+from pulsenotify.mail import DigestBatcher, digest_key, digest_subject
+
+
+def entry(task_id, emails=('releng@example.com',), subject='Task failed'):
+    task_data = SimpleNamespace(id=task_id, task_group_id='group1')
+    return task_data, {'emails': list(emails), 'subject': subject, 'message': '{} failed'.format(task_id)}
+
+
+def test_digest_key_ignores_recipients_order():
+    task_data, config = entry('task1', emails=('b@example.com', 'a@example.com'))
+    other_task_data, other_config = entry('task2', emails=('a@example.com', 'b@example.com'))
+    assert digest_key(task_data, config) == digest_key(other_task_data, other_config)
+
+
+def test_digest_subject():
+    assert digest_subject([entry('task1'), entry('task2')]) == 'Task failed (2 tasks)'
+    assert digest_subject([entry('task1'), entry('task2', subject='Task completed')]) == \
+        '2 notifications for task group group1'
+
+
+@pytest.mark.asyncio
+async def test_batches_notifications_until_window_closes():
+    digests = []
+
+    async def send(entries):
+        digests.append([task_data.id for task_data, _ in entries])
+
+    batcher = DigestBatcher(send, window=0.05, max_size=10)
+    await asyncio.gather(*[batcher.add('group1', entry(task_id)) for task_id in ('task1', 'task2', 'task3')])
+
+    #  gather doesn't guarantee the order the notifications are added in
+    assert [sorted(task_ids) for task_ids in digests] == [['task1', 'task2', 'task3']]
+    assert len(batcher) == 0
+
+
+@pytest.mark.asyncio
+async def test_sends_full_digest_right_away():
+    digests = []
+
+    async def send(entries):
+        digests.append(len(entries))
+
+    batcher = DigestBatcher(send, window=60, max_size=2)
+    await asyncio.wait_for(asyncio.gather(batcher.add('group1', entry('task1')),
+                                          batcher.add('group1', entry('task2'))), 1)
+
+    assert digests == [2]
+
+
+@pytest.mark.asyncio
+async def test_failed_digest_fails_every_notification():
+    async def send(entries):
+        raise RuntimeError('SES is down')
+
+    batcher = DigestBatcher(send, window=0.01, max_size=10)
+    results = await asyncio.gather(batcher.add('group1', entry('task1')), batcher.add('group1', entry('task2')),
+                                   return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_close_sends_open_digests():
+    digests = []
+
+    async def send(entries):
+        digests.append(len(entries))
+
+    batcher = DigestBatcher(send, window=60, max_size=10)
+    sent = batcher.add('group1', entry('task1'))
+    await batcher.close()
+    await sent
+
+    assert digests == [1]
+
+
+class TestEmailRenderer:
+
+    @pytest.fixture()
+    def renderer(self):
+        from pulsenotify.mail import EmailRenderer
+        return EmailRenderer(cache_size=2)
+
+    def test_reuses_rendered_part(self, renderer):
+        part = renderer.task_part('Task failed', 'task1 failed', 'https://inspector/task1', ['https://s3/log1'])
+        assert renderer.task_part('Task failed', 'task1 failed', 'https://inspector/task1', ('https://s3/log1',)) \
+            is part
+        assert renderer.task_part('Task failed', 'task2 failed', 'https://inspector/task2', ()) is not part
+        assert (renderer.hits, renderer.misses) == (1, 2)
+
+    def test_evicts_least_recently_used_part(self, renderer):
+        first = renderer.task_part('Task failed', 'task1 failed', 'https://inspector/task1', ())
+        renderer.task_part('Task failed', 'task2 failed', 'https://inspector/task2', ())
+        renderer.task_part('Task failed', 'task3 failed', 'https://inspector/task3', ())
+        assert renderer.task_part('Task failed', 'task1 failed', 'https://inspector/task1', ()) is not first
+
+    def test_shared_part_builds_separate_emails(self, renderer):
+        from pulsenotify.mail import build_email
+        part = renderer.task_part('Task failed', 'task1 failed', 'https://inspector/task1', ['https://s3/log1'])
+
+        first = build_email('Task failed', ['a@example.com'], part)
+        second = build_email('Task failed', ['b@example.com'], part, headers=[('In-Reply-To', '<group1@example.com>')])
+
+        assert 'To: a@example.com' in first
+        assert 'To: b@example.com' in second and 'In-Reply-To: <group1@example.com>' in second
+        assert 'To: b@example.com' not in first
@@ -0,0 +1,26 @@
+import asyncio
+import os
+import signal
+from unittest.mock import MagicMock, patch
+
+
+def test_sigterm_during_startup_shuts_down_the_worker():
+    from pulsenotify import main
+
+    async def connecting(consumer):
+        await asyncio.sleep(60)
+
+    async def shutdown():
+        pass
+
+    consumer = MagicMock()
+    consumer.shutdown = shutdown
+    loop = asyncio.new_event_loop()
+    loop.call_later(0.05, os.kill, os.getpid(), signal.SIGTERM)
+
+    with patch.object(main, 'NotifyConsumer', return_value=consumer), patch.object(main, 'worker', connecting), \
+            patch.object(main, 'METRICS_PORT', None):
+        main.run(loop)
+
+    assert consumer.start.called
+    assert loop.is_closed()
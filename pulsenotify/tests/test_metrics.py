@@ -0,0 +1,121 @@
+import pytest
+from unittest.mock import MagicMock
+
+
+def _point(value):
+    return {'measurement': 'notify_timing', 'fields': {'elapsed_time': str(value)}}
+
+
+@pytest.mark.asyncio
+async def test_influxdb_sink_writes_points_in_batches():
+    from pulsenotify.metrics import InfluxDBSink
+    client = MagicMock()
+    sink = InfluxDBSink(client, enabled=True, batch_size=2, flush_interval=60)
+
+    for value in range(5):
+        sink.record(_point(value))
+    await sink.close()
+
+    written = [call[0][0] for call in client.write_points.call_args_list]
+    assert [len(points) for points in written] == [2, 2, 1]
+    assert sum(written, []) == [_point(value) for value in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_influxdb_sink_drops_points_when_full():
+    from pulsenotify.metrics import InfluxDBSink
+    sink = InfluxDBSink(MagicMock(), enabled=True, batch_size=100, flush_interval=60, max_buffer=3)
+
+    for value in range(5):
+        sink.record(_point(value))
+
+    assert len(sink.buffer) == 3
+    assert sink.dropped == 2
+    await sink.close()
+
+
+def test_influxdb_sink_disabled_records_nothing():
+    from pulsenotify.metrics import InfluxDBSink
+    sink = InfluxDBSink(MagicMock(), enabled=False)
+
+    sink.record(_point(1))
+
+    assert sink.buffer == []
+
+
+def test_histogram_counts_observations_per_bucket_and_labels():
+    from pulsenotify.metrics import Histogram
+    histogram = Histogram('test_seconds', 'Test histogram.', buckets=(0.1, 1))
+
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value, stage='fetch_task')
+    histogram.observe(0.5, stage='ack')
+
+    fetch_task = histogram.series[(('stage', 'fetch_task'),)]
+    assert fetch_task['counts'] == [2, 1, 1]
+    assert fetch_task['count'] == 4
+    assert fetch_task['sum'] == pytest.approx(5.65)
+    assert histogram.series[(('stage', 'ack'),)]['counts'] == [0, 1, 0]
+
+
+def test_message_timings_records_stages_with_message_tags():
+    from pulsenotify.metrics import MessageTimings, stage_latency
+    timings = MessageTimings(status='task-failed', provisioner='test-provisioner')
+
+    with timings.stage('fetch_task'):
+        pass
+
+    assert [name for name, _ in timings.stages] == ['fetch_task']
+    key = (('provisioner', 'test-provisioner'), ('stage', 'fetch_task'), ('status', 'task-failed'))
+    assert stage_latency.series[key]['count'] == 1
+
+
+def test_registry_exposition_format():
+    from pulsenotify.metrics import Counter, Gauge, Histogram, Registry
+    registry = Registry()
+    notifications = registry.register(Counter('notifications_total', 'Notifications.'))
+    registry.register(Gauge('in_flight', 'In flight.', function=lambda: 3))
+    latency = registry.register(Histogram('latency_seconds', 'Latency.', buckets=(1,)))
+
+    notifications.inc(plugin='ses', result='sent')
+    notifications.inc(plugin='ses', result='sent')
+    latency.observe(0.5)
+    latency.observe(2)
+
+    assert registry.exposition().splitlines() == [
+        '# HELP notifications_total Notifications.',
+        '# TYPE notifications_total counter',
+        'notifications_total{plugin="ses",result="sent"} 2.0',
+        '# HELP in_flight In flight.',
+        '# TYPE in_flight gauge',
+        'in_flight 3.0',
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="1.0"} 1.0',
+        'latency_seconds_bucket{le="+Inf"} 2.0',
+        'latency_seconds_sum 2.5',
+        'latency_seconds_count 2.0',
+    ]
+
+
+def test_merge_snapshots_adds_counters_and_labels_gauges_by_worker(tmpdir):
+    from pulsenotify.metrics import Counter, Gauge, Registry, SnapshotWriter
+    from pulsenotify.metrics import merge_snapshots, read_snapshots, render_exposition
+
+    for worker_id, (consumed, in_flight) in enumerate(((3, 1), (4, 2))):
+        registry = Registry()
+        registry.register(Counter('consumed_total', 'Consumed.')).inc(consumed)
+        registry.register(Gauge('in_flight', 'In flight.')).set(in_flight)
+        SnapshotWriter(str(tmpdir.join('{}.json'.format(worker_id))), registry=registry).write()
+
+    exposition = render_exposition(merge_snapshots(read_snapshots(str(tmpdir))))
+
+    assert exposition.splitlines() == [
+        '# HELP consumed_total Consumed.',
+        '# TYPE consumed_total counter',
+        'consumed_total 7.0',
+        '# HELP in_flight In flight.',
+        '# TYPE in_flight gauge',
+        'in_flight{worker="0"} 1.0',
+        'in_flight{worker="1"} 2.0',
+    ]
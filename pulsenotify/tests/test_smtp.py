@@ -0,0 +1,64 @@
+import pytest
+from unittest.mock import MagicMock, patch
+
+
+class TestSMTP:
+
+    @pytest.fixture(scope='class')
+    def plugin(self):
+        from pulsenotify.plugins.smtp import Plugin
+        return Plugin()
+
+    def test_constructor(self, plugin):
+        import os
+        assert plugin.email == os.environ['SMTP_EMAIL']
+        assert plugin.pool.host == os.environ['SMTP_HOST']
+        assert hasattr(plugin, 'notify')
+
+
+class TestSMTPConnectionPool:
+
+    @pytest.fixture()
+    def pool(self):
+        from pulsenotify.plugins.smtp import SMTPConnectionPool
+        return SMTPConnectionPool('smtp.example.com', 587, 'user', 'passwd', size=1)
+
+    def test_reuses_session(self, pool):
+        with patch('smtplib.SMTP') as smtp:
+            smtp.return_value.noop.return_value = (250, b'OK')
+            pool.sendmail('from@example.com', ['to@example.com'], 'first')
+            pool.sendmail('from@example.com', ['to@example.com'], 'second')
+
+        assert smtp.call_count == 1
+        assert smtp.return_value.login.call_count == 1
+        assert smtp.return_value.sendmail.call_count == 2
+
+    def test_replaces_dropped_session(self, pool):
+        from smtplib import SMTPServerDisconnected
+
+        stale = MagicMock()
+        stale.noop.side_effect = SMTPServerDisconnected()
+        pool.release(stale)
+
+        with patch('smtplib.SMTP') as smtp:
+            pool.sendmail('from@example.com', ['to@example.com'], 'message')
+
+        assert not stale.sendmail.called
+        assert smtp.return_value.sendmail.call_count == 1
+
+    def test_discards_new_session_when_the_retry_fails(self, pool):
+        from smtplib import SMTPServerDisconnected
+
+        dropped = MagicMock()
+        dropped.noop.return_value = (250, b'OK')
+        dropped.sendmail.side_effect = SMTPServerDisconnected()
+        pool.release(dropped)
+
+        with patch('smtplib.SMTP') as smtp:
+            smtp.return_value.sendmail.side_effect = SMTPServerDisconnected()
+            with pytest.raises(SMTPServerDisconnected):
+                pool.sendmail('from@example.com', ['to@example.com'], 'message')
+
+        #  Neither session is kept, and the new one is closed rather than leaked
+        assert smtp.return_value.quit.call_count == 1
+        assert pool._idle.empty()
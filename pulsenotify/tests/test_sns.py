@@ -1,4 +1,8 @@
 import pytest
+from unittest.mock import MagicMock, patch
+
+from pulsenotify.plugins import NotificationFailedError
+from pulsenotify.util import CircuitOpenError
 
 
 class TestSNS:
@@ -11,3 +15,49 @@ class TestSNS:
     def test_constructor(self, plugin):
         import os
         assert plugin.arn == os.environ['SNS_ARN']
+
+    @staticmethod
+    def _failing_client(*errors):
+        calls = []
+        errors = list(errors)
+
+        async def call_client(method_name, **kwargs):
+            calls.append(method_name)
+            if errors:
+                raise errors.pop(0)
+
+        return calls, call_client
+
+    @pytest.mark.asyncio
+    async def test_notify_retries_failed_publishes_with_backoff(self, plugin):
+        calls, call_client = self._failing_client(OSError('connection reset'), OSError('connection reset'))
+        config = {'subject': 'subject', 'message': 'message'}
+
+        with patch.object(plugin, 'call_client', call_client), \
+                patch('pulsenotify.util.backoff_delay', return_value=0) as backoff_delay:
+            await plugin.notify(MagicMock(logs=None), config)
+
+        assert calls == ['publish'] * 3
+        assert backoff_delay.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_notify_gives_up_after_retries(self, plugin):
+        calls, call_client = self._failing_client(*[OSError('connection reset')] * 10)
+        config = {'subject': 'subject', 'message': 'message'}
+
+        with patch.object(plugin, 'call_client', call_client), patch('pulsenotify.util.backoff_delay', return_value=0):
+            with pytest.raises(NotificationFailedError):
+                await plugin.notify(MagicMock(logs=None), config)
+
+        assert len(calls) == 5
+
+    @pytest.mark.asyncio
+    async def test_notify_does_not_retry_while_circuit_is_open(self, plugin):
+        calls, call_client = self._failing_client(CircuitOpenError('open', retry_after=30))
+        config = {'subject': 'subject', 'message': 'message'}
+
+        with patch.object(plugin, 'call_client', call_client):
+            with pytest.raises(CircuitOpenError):
+                await plugin.notify(MagicMock(logs=None), config)
+
+        assert calls == ['publish']
@@ -0,0 +1,160 @@
+import pytest
+
+
+def _spool(tmpdir, **kwargs):
+    from pulsenotify.spool import RetrySpool
+    kwargs.setdefault('base_delay', 0)
+    return RetrySpool(path=str(tmpdir.join('spool.sqlite3')), **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_spooled_notification_is_delivered_and_removed(tmpdir):
+    spool = _spool(tmpdir)
+    delivered = []
+
+    async def deliver(plugin_name, entry):
+        delivered.append((plugin_name, entry))
+
+    await spool.add('ses', {'config': {'emails': ['a@example.com']}})
+    await spool.retry_due(deliver)
+
+    assert delivered == [('ses', {'config': {'emails': ['a@example.com']}})]
+    assert await spool.pending() == 0
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_redelivery_is_rescheduled_with_backoff(tmpdir):
+    spool = _spool(tmpdir)
+    attempts = []
+
+    async def deliver(plugin_name, entry):
+        attempts.append(plugin_name)
+        raise ConnectionError('still down')
+
+    await spool.add('sns', {})
+    #  The next attempt is scheduled up to an hour later, so it isn't due on the second pass
+    spool.base_delay = spool.max_delay = 3600
+    await spool.retry_due(deliver)
+    await spool.retry_due(deliver)
+
+    assert attempts == ['sns']
+    assert await spool.pending() == 1
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_notification_dropped_after_max_attempts(tmpdir):
+    spool = _spool(tmpdir, max_attempts=3)
+
+    async def deliver(plugin_name, entry):
+        raise ConnectionError('still down')
+
+    await spool.add('smtp', {})
+    for _ in range(3):
+        await spool.retry_due(deliver)
+
+    assert await spool.pending() == 0
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_permanent_failure_is_dropped_without_rescheduling(tmpdir):
+    from pulsenotify.plugins import NotificationFailedError
+    from pulsenotify.util import PermanentFailureError
+    spool = _spool(tmpdir)
+    attempts = []
+
+    async def deliver(plugin_name, entry):
+        attempts.append(plugin_name)
+        raise NotificationFailedError('Could not notify via SES') from PermanentFailureError()
+
+    await spool.add('ses', {})
+    await spool.retry_due(deliver)
+    await spool.retry_due(deliver)
+
+    assert attempts == ['ses']
+    assert await spool.pending() == 0
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_survives_restart(tmpdir):
+    spool = _spool(tmpdir)
+    await spool.add('ses', {'task': 'abc'})
+    await spool.close()
+
+    delivered = []
+
+    async def deliver(plugin_name, entry):
+        delivered.append(entry)
+
+    spool = _spool(tmpdir)
+    await spool.retry_due(deliver)
+    assert delivered == [{'task': 'abc'}]
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_queued_notification_is_only_retried_once_failed(tmpdir):
+    spool = _spool(tmpdir)
+    delivered = []
+
+    async def deliver(plugin_name, entry):
+        delivered.append(entry)
+
+    sent = await spool.enqueue('ses', {'task': 'sent'})
+    failed = await spool.enqueue('ses', {'task': 'failed'})
+    #  Queued notifications are being sent by the plugin queue, not retried
+    await spool.retry_due(deliver)
+    assert delivered == []
+
+    await spool.remove(sent)
+    await spool.failed(failed, 'ses', 'ConnectionError()')
+    await spool.retry_due(deliver)
+    assert delivered == [{'task': 'failed'}]
+    assert await spool.pending() == 0
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_queued_notification_is_retried_after_restart(tmpdir):
+    spool = _spool(tmpdir)
+    await spool.enqueue('irc', {'task': 'abc'})
+    await spool.close()
+
+    delivered = []
+
+    async def deliver(plugin_name, entry):
+        delivered.append((plugin_name, entry))
+
+    spool = _spool(tmpdir)
+    await spool.retry_due(deliver)
+    assert delivered == [('irc', {'task': 'abc'})]
+    await spool.close()
+
+
+def test_task_data_round_trips_through_a_record(task_ids):
+    from json import dumps, loads
+    from unittest.mock import MagicMock
+    from pulsenotify.consumer import TaskData
+    body = dumps({
+        'status': {
+            'taskId': task_ids['REAL_TASK'],
+            'provisionerId': 'aws-provisioner-v1',
+            'taskGroupId': task_ids['REAL_TASK'],
+            'runs': [{'runId': 0}],
+        }
+    }).encode('utf-8')
+    envelope = MagicMock()
+    envelope.exchange_name = 'exchange/taskcluster-queue/v1/task-failed'
+    task_data = TaskData(body, envelope, object())
+    task_data.definition = {'metadata': {'name': 'test'}}
+    task_data.logs = [(0, 'https://example.com/live.log')]
+
+    restored = TaskData.from_record(loads(dumps(task_data.to_record())))
+
+    assert restored.id == task_data.id
+    assert restored.status == 'task-failed'
+    assert restored.definition == task_data.definition
+    assert restored.logs == task_data.logs
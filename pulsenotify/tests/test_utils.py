@@ -1,6 +1,9 @@
+import aiohttp
 import pytest
+from time import monotonic
 
-from pulsenotify.util import retry_connection, RetriesExceededError
+from pulsenotify.util import retry_connection, backoff_delay, RetriesExceededError, PermanentFailureError
+from pulsenotify.util import CircuitBreaker, CircuitOpenError
 
 
 def _extract_chained_exception_message(pytest_exec_info):
@@ -62,6 +65,125 @@ async def test_retry_connection_allows_retries_to_be_by_passed():
         await retry_connection(error_function, sleep_interval_in_s=0.1, by_pass_exceptions=(_CustomException,))
 
 
+@pytest.mark.asyncio
+async def test_retry_connection_does_not_retry_permanent_failures():
+    calls = []
+
+    async def not_found_function():
+        calls.append(1)
+        raise aiohttp.HttpProcessingError(code=404)
+
+    with pytest.raises(PermanentFailureError):
+        await retry_connection(not_found_function, sleep_interval_in_s=0.1)
+
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_connection_retries_server_errors():
+    calls = []
+
+    async def flaky_function():
+        calls.append(1)
+        if len(calls) < 3:
+            raise aiohttp.HttpProcessingError(code=503)
+        return 'recovered'
+
+    assert await retry_connection(flaky_function, sleep_interval_in_s=0.01) == 'recovered'
+    assert len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_retry_connection_stops_at_deadline():
+    calls = []
+
+    async def error_function():
+        calls.append(1)
+        raise _CustomException("I won't pass")
+
+    started = monotonic()
+    with pytest.raises(RetriesExceededError):
+        await retry_connection(error_function, sleep_interval_in_s=10, deadline=monotonic() + 0.2)
+
+    assert monotonic() - started < 1
+    assert len(calls) < 5
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    for attempt in range(1, 10):
+        delay = backoff_delay(attempt, base_delay=1, max_delay=5)
+        assert 0 <= delay <= min(5, 2 ** (attempt - 1))
+
+
+class TestCircuitBreaker:
+
+    @staticmethod
+    def fail(breaker, exception=None):
+        with pytest.raises(Exception):
+            with breaker:
+                raise exception or ConnectionError()
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker('queue.example.com', failure_threshold=3, reset_timeout=60)
+        for _ in range(2):
+            self.fail(breaker)
+        assert breaker.state == CircuitBreaker.CLOSED
+
+        self.fail(breaker)
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError):
+            with breaker:
+                pass
+
+    def test_success_resets_failure_count(self):
+        breaker = CircuitBreaker('queue.example.com', failure_threshold=2, reset_timeout=60)
+        self.fail(breaker)
+        with breaker:
+            pass
+        self.fail(breaker)
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_permanent_failures_do_not_count(self):
+        breaker = CircuitBreaker('queue.example.com', failure_threshold=1, reset_timeout=60)
+        self.fail(breaker, aiohttp.HttpProcessingError(code=404))
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_probe(self):
+        breaker = CircuitBreaker('queue.example.com', failure_threshold=1, reset_timeout=0)
+        self.fail(breaker)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        #  A failed probe opens the circuit again
+        self.fail(breaker)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        #  Only one probe is let through at a time, and its success closes the circuit
+        with breaker:
+            assert breaker.state == CircuitBreaker.HALF_OPEN
+            with pytest.raises(CircuitOpenError):
+                with breaker:
+                    pass
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    @pytest.mark.asyncio
+    async def test_open_circuit_is_not_retried(self):
+        breaker = CircuitBreaker('queue.example.com', failure_threshold=1, reset_timeout=60)
+        self.fail(breaker)
+        calls = []
+
+        async def guarded_function():
+            with breaker:
+                calls.append(1)
+                return 'called'
+
+        #  Not a permanent failure: the endpoint is expected back, so the work is put off rather than dropped
+        with pytest.raises(CircuitOpenError) as error:
+            await retry_connection(guarded_function, sleep_interval_in_s=0.1)
+        assert not isinstance(error.value, RetriesExceededError)
+        assert 0 < error.value.retry_after <= 60
+        assert calls == []
+
+
 class TestFetchTask:
 
     @pytest.mark.asyncio
@@ -77,6 +199,88 @@ class TestFetchTask:
     async def test_fake_task(self, task_ids):
         from pulsenotify.util import fetch_task
 
-        resp = await fetch_task(task_ids['FAKE_TASK'])
+        #  Taskcluster refuses the request, and the error is raised rather than returned as the task definition
+        with pytest.raises(aiohttp.HttpProcessingError):
+            await fetch_task(task_ids['FAKE_TASK'])
+
+
+class TestTaskCache:
+
+    @staticmethod
+    def _counting_fetch(calls, delay=0):
+        import asyncio
+
+        async def fetch(task_id, session=None):
+            calls.append(task_id)
+            await asyncio.sleep(delay)
+            return {'taskGroupId': 'group', 'taskId': task_id}
+        return fetch
+
+    @pytest.mark.asyncio
+    async def test_cached_definition_is_reused(self):
+        from pulsenotify import metrics
+        from pulsenotify.util import TaskCache
+        calls = []
+        cache = TaskCache(fetch=self._counting_fetch(calls))
+        hits, misses = metrics.task_cache_hits.series.get((), 0), metrics.task_cache_misses.series.get((), 0)
+
+        first = await cache.fetch_task('task')
+        second = await cache.fetch_task('task')
+
+        assert first is second
+        assert calls == ['task']
+        assert (cache.hits, cache.misses) == (1, 1)
+        #  Exported as counters, so they can be rated and added up across workers
+        assert metrics.task_cache_hits.kind == 'counter'
+        assert metrics.task_cache_hits.series[()] - hits == 1
+        assert metrics.task_cache_misses.series[()] - misses == 1
+
+    @pytest.mark.asyncio
+    async def test_concurrent_fetches_are_coalesced(self):
+        import asyncio
+        from pulsenotify.util import TaskCache
+        calls = []
+        cache = TaskCache(fetch=self._counting_fetch(calls, delay=0.05))
+
+        results = await asyncio.gather(*[cache.fetch_task('task') for _ in range(5)])
+
+        assert calls == ['task']
+        assert all(result is results[0] for result in results)
+
+    @pytest.mark.asyncio
+    async def test_least_recently_used_definition_is_evicted(self):
+        from pulsenotify.util import TaskCache
+        calls = []
+        cache = TaskCache(size=2, fetch=self._counting_fetch(calls))
+
+        for task_id in ('one', 'two', 'one', 'three', 'one', 'two'):
+            await cache.fetch_task(task_id)
+
+        assert calls == ['one', 'two', 'three', 'two']
+        assert len(cache) == 2
+
+    @pytest.mark.asyncio
+    async def test_expired_definition_is_fetched_again(self):
+        from pulsenotify.util import TaskCache
+        calls = []
+        cache = TaskCache(ttl=0, fetch=self._counting_fetch(calls))
+
+        await cache.fetch_task('task')
+        await cache.fetch_task('task')
+
+        assert calls == ['task', 'task']
+
+    @pytest.mark.asyncio
+    async def test_error_responses_are_not_cached(self):
+        from pulsenotify.util import TaskCache
+        calls = []
+
+        async def fetch(task_id, session=None):
+            calls.append(task_id)
+            return {'code': 'ResourceNotFound'}
+
+        cache = TaskCache(fetch=fetch)
+        await cache.fetch_task('task')
+        await cache.fetch_task('task')
 
-        assert resp['code'] == 'InvalidRequestArguments'
+        assert calls == ['task', 'task']
@@ -1,14 +1,51 @@
 import aiohttp
 import asyncio
 import logging
-import influxdb
 import os
-from functools import wraps
-from time import time
+import random
+import smtplib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from time import monotonic, time
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+
+from pulsenotify import metrics
+from pulsenotify.metrics import record_timing
 
 log = logging.getLogger(__name__)
 
-db_cnxn = influxdb.InfluxDBClient(database=os.environ.get('INFLUXDB_NAME', 'time_notifications'))
+#  Base url of the Taskcluster queue API tasks and logs are fetched from
+QUEUE_URL = os.environ.get('TASKCLUSTER_QUEUE_URL', 'https://queue.taskcluster.net/v1')
+
+#  Connection pool settings for the HTTP client shared by Taskcluster fetches
+HTTP_POOL_SIZE = int(os.environ.get('PN_HTTP_POOL_SIZE', 20))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('PN_HTTP_KEEPALIVE_TIMEOUT', 30))
+
+#  Thread pool used by plugins for blocking network calls (boto3, smtplib)
+EXECUTOR_WORKERS = int(os.environ.get('PN_EXECUTOR_WORKERS', 10))
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+
+#  Number of task definitions kept in memory, and for how many seconds
+TASK_CACHE_SIZE = int(os.environ.get('PN_TASK_CACHE_SIZE', 1000))
+TASK_CACHE_TTL = float(os.environ.get('PN_TASK_CACHE_TTL', 3600))
+
+
+#  Retries back off exponentially from PN_RETRY_BASE_DELAY seconds up to PN_RETRY_MAX_DELAY seconds, with full jitter
+#  so workers that failed at the same time don't retry at the same time
+RETRY_ATTEMPTS = int(os.environ.get('PN_RETRY_ATTEMPTS', 5))
+RETRY_BASE_DELAY = float(os.environ.get('PN_RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.environ.get('PN_RETRY_MAX_DELAY', 10))
+
+#  HTTP client errors worth asking again for (request timeout, rate limited). Any other 4xx is permanent.
+RETRYABLE_CLIENT_STATUSES = (408, 429)
+
+#  Circuit breakers open after PN_BREAKER_FAILURES consecutive failures of an endpoint, and let a probe request
+#  through after PN_BREAKER_RESET_TIMEOUT seconds
+BREAKER_FAILURES = int(os.environ.get('PN_BREAKER_FAILURES', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('PN_BREAKER_RESET_TIMEOUT', 30))
 
 
 class RetriesExceededError(Exception):
@@ -16,38 +53,283 @@ class RetriesExceededError(Exception):
     pass
 
 
-async def retry_connection(async_func, *func_params, sleep_interval_in_s=10, by_pass_exceptions=()):
-    max_attempt = 5
+class PermanentFailureError(RetriesExceededError):
+    """ Exception raised without retrying when a call failed in a way another attempt can't fix (ie a 404) """
+    pass
+
+
+class CircuitOpenError(Exception):
+    """
+    Exception raised instead of calling an endpoint whose circuit breaker is open.
+
+    The endpoint is expected to come back, so the work is to be done again later rather than given up on. retry_after
+    is the number of seconds until the breaker lets a probe call through.
+    """
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_permanent_failure(exception):
+    if isinstance(exception, PermanentFailureError):
+        return True
+    if isinstance(exception, aiohttp.HttpProcessingError) and exception.code is not None:
+        return 400 <= exception.code < 500 and exception.code not in RETRYABLE_CLIENT_STATUSES
+    if isinstance(exception, ClientError):
+        status = getattr(exception, 'response', {}).get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return 400 <= status < 500 and status not in RETRYABLE_CLIENT_STATUSES
+    if isinstance(exception, smtplib.SMTPResponseException):
+        return exception.smtp_code >= 500
+    return False
+
+
+def failed_permanently(exception):
+    #  Whether exception or one of the exceptions it was raised from is a permanent failure, such as a plugin's
+    #  NotificationFailedError raised from a PermanentFailureError
+    while exception is not None:
+        if is_permanent_failure(exception):
+            return True
+        exception = exception.__cause__
+    return False
+
+
+def backoff_delay(attempt, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    #  Full jitter: a random delay between 0 and the exponential backoff for this attempt
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+async def retry_connection(async_func, *func_params, sleep_interval_in_s=RETRY_BASE_DELAY, by_pass_exceptions=(),
+                           max_attempts=RETRY_ATTEMPTS, max_delay=RETRY_MAX_DELAY, deadline=None):
+    #  Calls async_func until it returns a truthy value. Timeouts, connection errors and server errors are retried
+    #  with backoff, permanent failures are not. deadline is a time.monotonic() value after which no more attempts
+    #  are made, bounding how long a single message can spend retrying. Calls to an endpoint whose circuit is open
+    #  fail with CircuitOpenError straight away, for the caller to try again once the endpoint is back.
     current_attempt = 0
 
-    while current_attempt < max_attempt:
+    while current_attempt < max_attempts:
         current_attempt += 1
         try:
-            result = await async_func(*func_params)
+            if deadline is None:
+                result = await async_func(*func_params)
+            else:
+                result = await asyncio.wait_for(async_func(*func_params), max(deadline - monotonic(), 0))
             if result:
                 return result
             else:
                 raise ValueError('"{}" returned a falsey value: {}'.format(async_func.__name__, result))
+        except CircuitOpenError:
+            raise
         except by_pass_exceptions as e:
-            log.debug('By pass exception "%s" met. Stopping retry mechanism.')
+            log.debug('By pass exception "%s" met. Stopping retry mechanism.', e)
             raise e
         except Exception as e:
-            if current_attempt < max_attempt:
+            if is_permanent_failure(e):
+                log.warn('Permanent failure in "%s", not retrying. Reason: %s', async_func.__name__, e)
+                raise PermanentFailureError from e
+            if deadline is not None and monotonic() >= deadline:
+                log.warn('Time budget for "%s" exhausted after %s attempts.', async_func.__name__, current_attempt)
+                raise RetriesExceededError from e
+            if current_attempt < max_attempts:
                 log.warn('Cannot access network. Retrying. Reason: %s', e)
             else:
                 log.warn('Too many retries. Chaining latest issue...')
                 raise RetriesExceededError from e
 
-        log.warn('Fetch attempt %s failed, retrying in 10s...', current_attempt)
-        await asyncio.sleep(sleep_interval_in_s)
+            delay = backoff_delay(current_attempt, sleep_interval_in_s, max_delay)
+            if deadline is not None and monotonic() + delay >= deadline:
+                log.warn('Retrying "%s" would exceed its time budget. Chaining latest issue...', async_func.__name__)
+                raise RetriesExceededError from e
+
+        log.warn('Fetch attempt %s failed, retrying in %.1fs...', current_attempt, delay)
+        metrics.retries.inc(function=async_func.__name__)
+        await asyncio.sleep(delay)
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a remote endpoint once it has failed failure_threshold times in a row.
+
+    While the circuit is open, calls made through the breaker fail straight away with CircuitOpenError instead of
+    waiting for timeouts and going through their retries. After reset_timeout seconds a single probe call is let
+    through (half-open): the circuit closes again if it succeeds, and stays open for another reset_timeout if not.
+    Permanent failures (ie a 404) mean the endpoint is up and answering, so they don't count as failures.
+
+    Used as a context manager around each call to the endpoint:
+
+        with circuit_breaker(endpoint):
+            await make_request()
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
 
+    def __init__(self, name, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def __repr__(self):
+        return 'CircuitBreaker(name={}, state={})'.format(self.name, self.state)
+
+    def allow(self):
+        if self.state == self.OPEN:
+            if monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            log.info('Circuit for %s is half-open, probing', self.name)
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            #  Only one probe at a time, everything else keeps failing fast until it comes back
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            log.info('Circuit for %s closed', self.name)
+            self._set_state(self.CLOSED)
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            log.warn('Circuit for %s opened after %s consecutive failures', self.name, self.failures)
+            self._set_state(self.OPEN)
+        if self.state == self.OPEN:
+            self.opened_at = monotonic()
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.circuit_breaker_open.set(int(state != self.CLOSED), endpoint=self.name)
+
+    def retry_after(self):
+        #  Seconds until a probe call is let through. While a probe is in flight, assume it will fail.
+        if self.state == self.OPEN:
+            return max(self.reset_timeout - (monotonic() - self.opened_at), 0)
+        return self.reset_timeout
+
+    def __enter__(self):
+        if not self.allow():
+            raise CircuitOpenError('Circuit for {} is open'.format(self.name), retry_after=self.retry_after())
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None or (isinstance(exc, Exception) and is_permanent_failure(exc)):
+            self.record_success()
+        else:
+            self.record_failure()
+        return False
+
+
+_circuit_breakers = {}
+
+
+def circuit_breaker(endpoint):
+    #  Returns the breaker shared by every call made to an endpoint (ie a host:port)
+    breaker = _circuit_breakers.get(endpoint)
+    if breaker is None:
+        breaker = _circuit_breakers[endpoint] = CircuitBreaker(endpoint)
+    return breaker
+
+
+def endpoint_of(url):
+    return urlparse(url).netloc
+
+
+async def run_blocking(func, *args, **kwargs):
+    #  Runs a blocking call on the shared thread pool, so a slow AWS or SMTP round-trip doesn't freeze the event loop
+    #  (and with it every other notification, the IRC connection and the AMQP heartbeats)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+def create_http_session(loop=None):
+    #  A long-lived session keeps connections to queue.taskcluster.net alive between messages, so each fetch
+    #  reuses an open TCP+TLS connection instead of performing a new handshake. Resolved hosts are cached as well.
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE,
+                                     keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                                     use_dns_cache=True,
+                                     loop=loop)
+    return aiohttp.ClientSession(connector=connector, loop=loop)
+
+
+async def fetch_task(task_id, session=None):
+    if session is None:
+        with aiohttp.ClientSession() as session:
+            return await fetch_task(task_id, session)
 
-async def fetch_task(task_id):
     log.info('Fetching task %s from Taskcluster', task_id)
-    url = "https://queue.taskcluster.net/v1/task/{}".format(task_id)
-    with aiohttp.Timeout(10), aiohttp.ClientSession() as session:
-        response = await session.get(url)
-        return await response.json()
+    url = "{queue_url}/task/{task_id}".format(queue_url=QUEUE_URL, task_id=task_id)
+    with circuit_breaker(endpoint_of(url)), aiohttp.Timeout(10):
+        async with session.get(url) as response:
+            response.raise_for_status()
+            return await response.json()
+
+
+class TaskCache(object):
+    """
+    Bounded LRU cache of task definitions, keyed by taskId.
+
+    The same task shows up on several exchanges (task-failed then task-exception, reruns, each run completing),
+    and its definition never changes once created, so fetched definitions are kept for ttl seconds. Concurrent
+    fetches of the same taskId share a single request to Taskcluster.
+    """
+    def __init__(self, size=TASK_CACHE_SIZE, ttl=TASK_CACHE_TTL, fetch=fetch_task):
+        self.size = size
+        self.ttl = ttl
+        self.fetch = fetch
+        self.hits = 0
+        self.misses = 0
+        self._definitions = OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._definitions)
+
+    async def fetch_task(self, task_id, session=None):
+        cached = self._definitions.get(task_id)
+        if cached is not None:
+            expires_at, definition = cached
+            if expires_at > monotonic():
+                self._definitions.move_to_end(task_id)
+                self.hits += 1
+                metrics.task_cache_hits.inc()
+                return definition
+            del self._definitions[task_id]
+
+        pending = self._pending.get(task_id)
+        if pending is not None:
+            self.hits += 1
+            metrics.task_cache_hits.inc()
+        else:
+            self.misses += 1
+            metrics.task_cache_misses.inc()
+            pending = asyncio.ensure_future(self.fetch(task_id, session))
+            pending.add_done_callback(partial(self._fetched, task_id))
+            self._pending[task_id] = pending
+
+        #  Shielded so a waiter being cancelled doesn't cancel the fetch for the others
+        return await asyncio.shield(pending)
+
+    def _fetched(self, task_id, future):
+        del self._pending[task_id]
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        #  Error responses (ie for an unknown taskId) are not definitions and aren't kept
+        definition = future.result()
+        if not definition or 'taskGroupId' not in definition:
+            return
+
+        self._definitions[task_id] = (monotonic() + self.ttl, definition)
+        while len(self._definitions) > self.size:
+            self._definitions.popitem(last=False)
 
 
 def async_time_me(f):
@@ -59,16 +341,6 @@ def async_time_me(f):
 
         log.debug('notify coroutine for %r took %2.4f sec', f.__module__.split('.')[-1], t_f - t_i)
 
-        if bool(int(os.environ['INFLUXDB_RECORD'])):
-            db_cnxn.write_points([{
-                "measurement": "notify_timing",
-                "tags": {
-                    "host": os.environ.get('INFLUXDB_HOST', 'local'),
-                    "service": f.__module__.split('.')[-1]
-                },
-                "fields": {
-                    "elapsed_time": str(t_f - t_i)
-                }
-            }])
+        record_timing(f.__module__.split('.')[-1], t_f - t_i)
         return result
     return timed
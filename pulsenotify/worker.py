@@ -1,10 +1,38 @@
 import aioamqp
+import asyncio
 import logging
 import os
 
 log = logging.getLogger(__name__)
 
 
+class Consumption(object):
+    """
+    Starts and stops the delivery of messages from a queue to the consumer, to pause consumption while the consumer
+    can't keep up. Stopping cancels the AMQP consumer, messages already delivered are still processed and acknowledged.
+    """
+    def __init__(self, channel, queue_name, callback):
+        self.channel = channel
+        self.queue_name = queue_name
+        self.callback = callback
+        self.consumer_tag = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._lock:
+            if self.consumer_tag is None:
+                result = await self.channel.basic_consume(self.callback, queue_name=self.queue_name)
+                self.consumer_tag = result['consumer_tag']
+                log.info('Consuming from %s', self.queue_name)
+
+    async def stop(self):
+        async with self._lock:
+            if self.consumer_tag is not None:
+                await self.channel.basic_cancel(self.consumer_tag)
+                self.consumer_tag = None
+                log.info('Stopped consuming from %s', self.queue_name)
+
+
 async def worker(consumer):
     try:
         transport, protocol = await aioamqp.connect(
@@ -19,7 +47,8 @@ async def worker(consumer):
         return
 
     channel = await protocol.channel()
-    await channel.basic_qos(prefetch_count=1, prefetch_size=0,
+    #  Let Pulse deliver as many unacknowledged messages as the consumer is willing to process at once
+    await channel.basic_qos(prefetch_count=consumer.max_in_flight, prefetch_size=0,
                             connection_global=False)
     queue_name = 'queue/%s/%s' % (os.environ['PULSE_LOGIN'], os.environ['PULSE_QUEUE'],)
     log.info("Using queue: %s", queue_name)
@@ -30,6 +59,7 @@ async def worker(consumer):
             await channel.queue_bind(exchange_name=exchange,
                                      queue_name=queue_name,
                                      routing_key=key)
-    await channel.basic_consume(consumer.dispatch, queue_name=queue_name)
+    consumer.consumption = Consumption(channel, queue_name, consumer.dispatch)
+    await consumer.consumption.start()
 
     log.info('Worker has completed running.')